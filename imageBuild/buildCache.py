@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# Client side of the remote section cache used by imageBuild.py
+#
+# Protocol (see cacheServer.py for a reference server):
+#   GET  <url>/v1/artifacts/<key>  -> 200 + artifact, 404 on miss
+#   PUT  <url>/v1/artifacts/<key>  -> 201 once stored
+# <key> is the hex sha256 of all the inputs of a section. Every transfer
+# carries the sha256 of the artifact itself in the X-Content-Sha256 header,
+# which both ends verify before the artifact is used or stored.
+import os
+import hashlib
+import urllib.request
+import urllib.error
+
+PROTOCOL_VERSION = 'v1'
+DIGEST_HEADER    = 'X-Content-Sha256'
+CHUNK_SIZE       = 1024 * 1024
+
+def fileDigest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def treeDigest(dir):
+    """Digest of the names and content of the files under dir, python
+    caches left out"""
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(dir):
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            h.update(os.path.relpath(path, dir).encode() + b'\0')
+            h.update(fileDigest(path).encode())
+    return h.hexdigest()
+
+def isValidKey(key):
+    return len(key) == 64 and all(c in '0123456789abcdef' for c in key)
+
+def sectionDigest(sectionName, info, archives, baseEntries, tools, extra=()):
+    # Key of a section artifact. Only content goes in, never the location of
+    # the inputs, so that nodes with different paths share hits.
+    h = hashlib.sha256()
+    def add(tag, value):
+        if isinstance(value, str):
+            value = value.encode()
+        h.update(b'%s:%d:' % (tag.encode(), len(value)))
+        h.update(value)
+
+    add('protocol', PROTOCOL_VERSION)
+    add('section', sectionName)
+    add('info', repr(sorted((k, v) for k, v in info.items()
+                            if k not in ('mergedArchive', 'finalArchive'))))
+    for arc in archives:
+        add('archive', fileDigest(arc))
+    for (entryName, entryPath) in baseEntries:
+        add('entry', entryName)
+        add('content', fileDigest(entryPath) if os.path.exists(entryPath) else '')
+    for tool in tools:
+        add('tool', fileDigest(tool) if os.path.exists(tool) else os.path.basename(tool))
+    for value in extra:
+        add('extra', str(value))
+    return h.hexdigest()
+
+class RemoteCache:
+    def __init__(self, url, upload=True, timeout=30):
+        self.url     = url.rstrip('/')
+        self.upload  = upload
+        self.timeout = timeout
+        self.hits    = 0
+        self.misses  = 0
+
+    def _artifactUrl(self, key):
+        return f"{self.url}/{PROTOCOL_VERSION}/artifacts/{key}"
+
+    def fetch(self, key, dstPath):
+        """Fetch artifact 'key' into dstPath. Returns True on a verified hit.
+        A miss, a server error or a corrupted transfer all return False so
+        the caller falls back to a local build."""
+        tmpPath = dstPath + '.part'
+        try:
+            with urllib.request.urlopen(self._artifactUrl(key), timeout=self.timeout) as resp:
+                expected = resp.headers.get(DIGEST_HEADER)
+                h = hashlib.sha256()
+                with open(tmpPath, 'wb') as f:
+                    for chunk in iter(lambda: resp.read(CHUNK_SIZE), b''):
+                        h.update(chunk)
+                        f.write(chunk)
+            if expected is None or h.hexdigest() != expected.lower():
+                print(f"WARN: cache artifact {key} failed integrity check, ignoring it")
+                os.remove(tmpPath)
+                self.misses += 1
+                return False
+            os.replace(tmpPath, dstPath)
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                print(f"WARN: cache fetch of {key} failed: HTTP {e.code}")
+            self.misses += 1
+            if os.path.exists(tmpPath): os.remove(tmpPath)
+            return False
+        except (urllib.error.URLError, OSError) as e:
+            print(f"WARN: cache fetch of {key} failed: {e}")
+            self.misses += 1
+            if os.path.exists(tmpPath): os.remove(tmpPath)
+            return False
+
+        self.hits += 1
+        return True
+
+    def store(self, key, srcPath):
+        """Upload srcPath as artifact 'key'. Failures are reported but never
+        fatal - the local build already has the result."""
+        if not self.upload:
+            return False
+        try:
+            digest = fileDigest(srcPath)
+            with open(srcPath, 'rb') as f:
+                req = urllib.request.Request(self._artifactUrl(key), data=f, method='PUT')
+                req.add_header(DIGEST_HEADER, digest)
+                req.add_header('Content-Length', str(os.path.getsize(srcPath)))
+                req.add_header('Content-Type', 'application/octet-stream')
+                with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                    resp.read()
+        except (urllib.error.URLError, OSError) as e:
+            print(f"WARN: cache upload of {key} failed: {e}")
+            return False
+        return True
+
+    def summary(self):
+        return f"cache: {self.hits} hit(s), {self.misses} miss(es)"
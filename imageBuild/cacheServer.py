@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# Reference server for the imageBuild.py remote section cache.
+#
+# Stores artifacts as plain files named by their key under --dir. It is meant
+# to run on a single machine or a trusted build network; there is no
+# authentication. See buildCache.py for the protocol.
+#
+# examples:
+#   > cacheServer.py --dir ~/.cache/op-image-tools/server --port 8787
+#   > imageBuild.py <configfile> ... --cache_url http://localhost:8787
+import os
+import sys
+import argparse
+import hashlib
+import tempfile
+import http.server
+
+from buildCache import PROTOCOL_VERSION, DIGEST_HEADER, CHUNK_SIZE, fileDigest, isValidKey
+
+class CacheHandler(http.server.BaseHTTPRequestHandler):
+    storeDir = None
+
+    def _key(self):
+        prefix = f"/{PROTOCOL_VERSION}/artifacts/"
+        if not self.path.startswith(prefix):
+            return None
+        key = self.path[len(prefix):]
+        return key if isValidKey(key) else None
+
+    def _reply(self, code, message=''):
+        body = message.encode()
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _sendArtifact(self, withBody):
+        key = self._key()
+        if key is None:
+            return self._reply(400, 'bad artifact key\n')
+        path = os.path.join(self.storeDir, key)
+        if not os.path.exists(path):
+            return self._reply(404)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.send_header(DIGEST_HEADER, fileDigest(path))
+        self.end_headers()
+        if withBody:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    self.wfile.write(chunk)
+
+    def do_HEAD(self):
+        self._sendArtifact(False)
+
+    def do_GET(self):
+        self._sendArtifact(True)
+
+    def do_PUT(self):
+        key = self._key()
+        if key is None:
+            return self._reply(400, 'bad artifact key\n')
+        expected = self.headers.get(DIGEST_HEADER)
+        length = self.headers.get('Content-Length')
+        if expected is None or length is None:
+            return self._reply(411, f"Content-Length and {DIGEST_HEADER} required\n")
+
+        try:
+            remaining = int(length)
+        except ValueError:
+            remaining = -1
+        if remaining < 0:
+            # The body can't be skipped without a length
+            self.close_connection = True
+            return self._reply(400, 'bad Content-Length\n')
+
+        # Receive into a temporary file and only publish it once verified, so
+        # a concurrent GET never sees a partial artifact.
+        h = hashlib.sha256()
+        fd, tmpPath = tempfile.mkstemp(dir=self.storeDir, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while remaining > 0:
+                    chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            if remaining != 0 or h.hexdigest() != expected.lower():
+                os.remove(tmpPath)
+                return self._reply(422, 'integrity check failed\n')
+            os.replace(tmpPath, os.path.join(self.storeDir, key))
+        except OSError as e:
+            if os.path.exists(tmpPath): os.remove(tmpPath)
+            return self._reply(500, f"{e}\n")
+        self._reply(201)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+def makeServer(storeDir, bind='127.0.0.1', port=8787, quiet=False):
+    storeDir = os.path.realpath(os.path.expanduser(storeDir))
+    os.makedirs(storeDir, exist_ok=True)
+    handler = type('BoundCacheHandler', (CacheHandler,), {'storeDir': storeDir})
+    server = http.server.ThreadingHTTPServer((bind, port), handler)
+    server.quiet = quiet
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reference imageBuild.py section cache server")
+    parser.add_argument('--dir', default='~/.cache/op-image-tools/server',
+                        help='Directory to store artifacts in. '
+                        'default ~/.cache/op-image-tools/server')
+    parser.add_argument('--bind', default='127.0.0.1',
+                        help='Address to listen on. default 127.0.0.1')
+    parser.add_argument('--port', type=int, default=8787,
+                        help='Port to listen on. default 8787')
+    parser.add_argument('--quiet', action='store_true',
+                        help="Don't log requests")
+    args = parser.parse_args()
+
+    server = makeServer(args.dir, args.bind, args.port, args.quiet)
+    print(f"INFO: serving {server.RequestHandlerClass.storeDir} on "
+          f"http://{args.bind}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    sys.exit(0)
@@ -5,19 +5,43 @@ import argparse
 import textwrap
 import subprocess
 import ast
+import copy
 import shutil
 import tarfile
+import tempfile
+import fcntl
+import gzip
 import inspect
 import platform
-
+import json
+import time
+import threading
+import importlib
+import contextlib
+import concurrent.futures
+import hashlib
+
+import perfHistory
+import imageExport
+import testResults
+import sharedCache
+from buildCache import RemoteCache, sectionDigest, fileDigest, treeDigest
+from stageFiles import stageFiles, linkFile, copyFile, appendFile, sparsify, tempPath
+from jobServer import sharedJobServer, limitCommand, parseSize
+
+
+class ImageBuildError(Exception):
+    """Raised by ImageBuilder when the build can not continue. 'rc' is the
+    exit code the command line tool ends with."""
+    def __init__(self, message, rc=1):
+        super().__init__(message)
+        self.rc = rc if rc else 1
 
 def checkEnvVarExist(var):
     if os.environ.get(var) is None:
-        print("Error: env var %s not found" % var)
-        sys.exit(1)
-    elif os.environ.get(var) is '':
-        print("Error: env var %s found but not set" % var)
-        sys.exit(1)
+        raise ImageBuildError("Error: env var %s not found" % var)
+    elif os.environ.get(var) == '':
+        raise ImageBuildError("Error: env var %s found but not set" % var)
     else:
         print("env var %s found with value" % var, os.getenv(var))
 
@@ -26,913 +50,1716 @@ def readConfigFile(configFile):
         try:
             configData = ast.parse(f.read(), mode="eval")
         except SyntaxError as e:
-            print("Syntax error parsing manifest, line %d. Entry: '%s'" %
-                    (e.lineno, e.text.strip()),file=sys.stderr)
-            sys.exit(1)
+            raise ImageBuildError("Syntax error parsing manifest, line %d. Entry: '%s'" %
+                    (e.lineno, e.text.strip()))
         try:
             data = ast.literal_eval(configData)
         except ValueError as e:
             # Get the error data, both the message and location
             exc_type, exc_value, exc_traceback = sys.exc_info()
-            # First the error message
-            print("%s" % (exc_value),file=sys.stderr)
             # Now get the line number and position
             last_tb = exc_traceback
             while last_tb.tb_next:
                 last_tb = last_tb.tb_next
-            print("Found at location: line=%d, col=%d" %
-                    (last_tb.tb_frame.f_locals["node"].lineno,
-                       last_tb.tb_frame.f_locals["node"].col_offset),file=sys.stderr)
-            sys.exit(1)
+            raise ImageBuildError("%s\nFound at location: line=%d, col=%d" %
+                    (exc_value,
+                     last_tb.tb_frame.f_locals["node"].lineno,
+                     last_tb.tb_frame.f_locals["node"].col_offset))
     if not 'image_sections' in data.keys():
-        print("Required key 'image_sections' not found in config data",file=sys.stderr)
-        sys.exit(1)
+        raise ImageBuildError("Required key 'image_sections' not found in config data")
 
     return data
 
-def mergeArchives(sectionName, archiveFileList, baseEntries):
-    # Create an empty archive for the section
-    mergedArchiveFile = os.path.join(mergedDir, sectionName+'.pak')
-    if os.path.exists(mergedArchiveFile): os.remove(mergedArchiveFile)
-    archive = pak.Archive(mergedArchiveFile)
-
-    # Add essential entries
-    for (entryName,entryPath) in baseEntries:
-        entryData = ''.encode()
-        if os.path.exists(entryPath):
-            with open(entryPath, "rb") as f:
-                entryData = f.read()
-
-        archive.add(entryName, pak.CM.store ,entryData)
-    archive.save()
-
-    # Merge archives
-    if len(archiveFileList) > 0:
-        cmd = "%s merge %s %s" % (pakTool, mergedArchiveFile, ' '.join(archiveFileList))
-        resp = subprocess.run(cmd.split())
-        if resp.returncode != 0:
-            print("ERROR: %s failed with rc %d" % (cmd, resp.returncode))
-            exit(1)
-
-    return mergedArchiveFile
-
-def setupRepository(basePath, commit,remote):
-    print("basePath: %s" % basePath)
-    if not os.path.exists(basePath):
-        if not args.no_downloads:
-            #Download repo
-            print("git repo %s does not exist. Attempting to clone it" % basePath)
-            basePath=basePath.rstrip('/')
-            (dir,repo_name) = os.path.split(basePath)
-            os.makedirs(dir,exist_ok=True)
-            os.chdir(dir)
-            print("cwd: %s  repo: %s" % (os.getcwd(),repo_name))
-            cmd = 'git clone -b %s ssh://gerrit-server/%s %s -o gerrit' % (commit, remote, repo_name)
-            print(cmd)
-            resp = subprocess.run(cmd.split())
-            if resp.returncode != 0:
-                print("git clone failed with rc %d" % resp.returncode)
-                os.chdir(cwd)
-                sys.exit(1)
-
-    if not os.path.exists(os.path.join(basePath,'.git')):
-        print("%s is not a git repositry" % basePath,file=sys.stderr)
-        sys.exit(1)
+def extractTar(tarPath, dest):
+    with tarfile.open(tarPath) as tar:
+        if 'filter' in inspect.signature(tarfile.TarFile.extractall).parameters:
+            tar.extractall(dest,filter="data")
+        else:
+            tar.extractall(dest)
+
+def createTar(tarPath, srcDir, epoch=None):
+    """Archive srcDir as a .tar.gz. With epoch (SOURCE_DATE_EPOCH) the
+    archive only depends on the content: entries in sorted order, mtimes
+    clamped to epoch, no owners, normalized modes and a fixed gzip header."""
+    if epoch is None:
+        with tarfile.open(tarPath, "w:gz") as archive:
+            archive.add(srcDir, arcname=os.path.basename(srcDir))
+        return
 
-    os.chdir(basePath)
-    if not args.nobranchchange:
-        resp = subprocess.run(["git","checkout",commit],stdout=subprocess.PIPE)
-        if resp.returncode != 0:
-            print("git checkout had returncode %d" % resp.returncode,file=sys.stderr)
-            os.chdir(cwd)
-            sys.exit(1)
-        if args.update:
-            if 'sbe' in remote:
-                cmd = 'git pull'
-                print(cmd)
-                resp = subprocess.run(cmd.split())
-                if resp.returncode != 0:
-                    print("git update failed with rc %d" % resp.returncode)
-                    os.chdir(cwd)
-                    sys.exit(1)
-            elif 'ekb' in remote:
-                cmd = 'git fetch gerrit'
-                print(cmd)
-                resp = subprocess.run(cmd.split())
-                if resp.returncode != 0:
-                    print("git update failed with rc %d" % resp.returncode)
-                    os.chdir(cwd)
-                    sys.exit(1)
-                cmd = 'git rebase gerrit/%s' % (commit)
-                print(cmd)
-                resp = subprocess.run(cmd.split())
-                if resp.returncode != 0:
-                    print("git update failed with rc %d" % resp.returncode)
-                    os.chdir(cwd)
-                    sys.exit(1)
-            else:
-                print('Unknown remote: %s' % remote,file=sys.stderr)
-                os.chdir(cwd)
-                sys.exit(1)
-
-    if 'sbe' in remote:
-        cmd= config['sbeWorkon']
-        build_cmd=config['sbeBuild']
-        if (args.devready or args.devreadysbe):
-            if not args.nobranchchange:
-                getDevReadyCommits('sbe', commit)
-            else:
-                print("Not getting dev-ready updates because --nobranchchange was specified")
-
-    elif 'ekb' in remote:
-        cmd= config['ekbWorkon']
-        build_cmd= config['ekbBuild']
-        if (args.devready or args.devreadyekb):
-            if not args.nobranchchange:
-                getDevReadyCommits('ekb', commit)
-            else:
-                print("Not getting dev-ready updates because --nobranchchange was specified")
-    else:
-        print('Unknown remote: %s' % remote,file=sys.stderr)
-        os.chdir(cwd)
-        sys.exit(1)
+    def normalize(info):
+        info.mtime = min(int(info.mtime), epoch)
+        info.uid = info.gid = 0
+        info.uname = info.gname = ''
+        if info.isdir() or info.mode & 0o111:
+            info.mode = 0o755
+        else:
+            info.mode = 0o644
+        return info
+
+    base = os.path.basename(srcDir)
+    with open(tarPath, 'wb') as f, \
+         gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=epoch) as gz, \
+         tarfile.open(fileobj=gz, mode='w', format=tarfile.GNU_FORMAT) as archive:
+        archive.add(srcDir, arcname=base, recursive=False, filter=normalize)
+        for root, dirs, files in os.walk(srcDir):
+            dirs.sort()
+            arcRoot = os.path.join(base, os.path.relpath(root, srcDir))
+            for name in sorted(dirs + files):
+                archive.add(os.path.join(root, name),
+                            arcname=os.path.normpath(os.path.join(arcRoot, name)),
+                            recursive=False, filter=normalize)
 
-    with subprocess.Popen(cmd.split(),stdin=subprocess.PIPE) as proc:
-        proc.communicate(input=str.encode(build_cmd))
-        if proc.returncode != 0:
-            print("Building %s had a returncode %d" % (
-                basePath,
-                proc.returncode),
-                file=sys.stderr)
-            os.chdir(cwd)
-            sys.exit(1)
-
-def buildPartitionTable(partitions):
-    # Write the  partitions file
-    partitionsfile = os.path.join(genDir,'partitions')
-    with open(partitionsfile,'w') as f:
-        print(partitions, file=f)
-
-    # Build part.tbl
-    cmd = "%s compile-ptable %s %s/part.tbl" % (
-            flashBuildTool,
-            partitionsfile,
-            genDir)
-    #print(cmd)
+def download(url, dir):
+    os.makedirs(dir,exist_ok=True)
+    cmd = f"wget {url} -P {dir}"
+    print(cmd)
     resp = subprocess.run(cmd.split())
-    if resp.returncode !=0:
-        print("falshBuildTool failed to build part.table. rc = %d" % resp.returncode)
-        sys.exit(resp.returncode)
+    if resp.returncode != 0:
+        raise ImageBuildError(f"{cmd} failed with rc {resp.returncode}", resp.returncode)
+    return os.path.join(dir,os.path.basename(url))
 
-    return partitionsfile
 
-def getDevReadyCommits(repo, commit):
-    print("\nRunning ./", repo, " cronus checkout")
-    if (repo == 'sbe'):
-        dev_out_file = 'cro_ody_sbe_image_cronus_checkout.sversion'
-        dev_out, err = subprocess.Popen(['export PROJECT_NAME=sbe; export SBEROOT=`pwd` export SBEROOT_INT=`pwd`/internal; export SBE_INSIDE_WORKON=1; source ./internal/projectrc; ./sbe cronus_devready checkout; unset SBE_INSIDE_WORKON; unset PROJECT_NAME; unset SBEROOT; unset SBEROOT_INT;'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, universal_newlines=True).communicate()
-    else:
-        dev_out_file = 'cro_ody_ekb_image_cronus_checkout.sversion'
-        dev_out, err = subprocess.Popen(['source ./env.bash; ./ekb cronus checkout --branch', commit], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, universal_newlines=True).communicate()
-    # Sometimes seeing stuff in stderr that isn't actually an error, so not going to fail
-    if err:
-        print("INFO: stderr returned:\n", err)
-
-    print(repo, " cronus checkout --branch", commit, "\n")
-    print(dev_out)
-
-    # look for explicit problems
-    if ('Outstanding tracked changes' or 'Not a git repository' or 'Run this tool from the root' or 'Cherry-picks failed') in dev_out:
-        print("ERROR! Failed checking of dev-ready checkouts\n", dev_out)
-        os.chdir(cwd)
-        sys.exit(1)
-
-    # look for confirmation it worked
-    if not ('Checking out' and 'All Cherry-picks applied cleanly') in dev_out:
-        print("ERROR! Failed checking out dev-ready checkouts\n", dev_out)
-        os.chdir(cwd)
-        sys.exit(1)
-
-    # write output to a file
-    filename = os.path.join(output, dev_out_file)
-    outfile = open(filename, 'w')
-    outfile.write(dev_out)
-    outfile.close()
-
-def makeHashList(archiveName,hashfile):
-    # Create and load the archive
-    archive = pak.Archive(archiveName)
-    archive.load()
-
-    # Create all the hashes for the selected files
-    out.print("Creating hashes")
-    out.moreIndent()
-    for entry in archive:
-       out.print(entry.name)
-       entry.hash()
-    out.lessIndent()
-
-    #Add the hash.list content
-    archive.add(hashfile, pak.CM.store, archive.createHashList())
-
-    # Write the updated archive
-    return archive.save()
-
-def saveAndRemove(archiveName, savedArch, extractList):
-    archive = pak.Archive(archiveName)
-    archive.load()
-
-    # An non-existant or empty list would extract everything - don't allow
-    if not extractList:
-        return
+class ImageBuilder:
+    """Builds one image from a config file.
 
-    try:
-        # Filter the list
-        result = archive.find(extractList)
-    except pak.ArchiveError as e:
-        out.print(str(e))
-        return
+    options is the argparse.Namespace of the command line tool (see
+    makeParser()); keyword arguments override single options, e.g.
+        ImageBuilder('configs/...', sbe='~/sbe', ovrd='ovrd', output='out')
 
-    # Write the files
-    for entry in result:
-        savedArch.append(entry)
-        archive.remove(entry)
+    callbacks maps a stage name (see STAGES, '*' for all stages) to a callable
+    or list of callables, called as callback(builder, stage, event) with event
+    'start', then 'end' or, when the stage raised, 'error'.
 
-    # Write it back out
-    archive.save()
+    Tools (sbe_tools, paktool, flashbuild, pakcore) are discovered by the first
+    build and again when sbe_tools changes; build() can be called repeatedly.
+    pakcore is imported process wide, so all builders of a process must use
+    the same pak modules.
+    """
 
-    return
+    STAGES = ['setup', 'binaries', 'tools', 'ptable'] + perfHistory.STAGES
 
-def restoreSaved(archiveName, savedArc):
-    archive = pak.Archive(archiveName)
-    archive.load()
+    #### Build stages
+    ####    Note : Below stage will be skipped if section is configured with 'signed_image'
+    ####           and '--allowToSign' option is not passed since the SBE provides
+    ####           frozen signed images so tool should not attempt to sign.
+    stage1 = 'merged'
+    stage2 = 'signed'
+    stage3 = 'final'  #hashed
 
-    for entry in savedArc:
-        archive.append(entry)
+    def __init__(self, configfile, options=None, callbacks=None, **overrides):
+        if options is None:
+            options = makeParser().parse_args([configfile])
+        else:
+            options = copy.copy(options)
+        options.configfile = configfile
+        for key, value in overrides.items():
+            setattr(options, key, value)
+        self.args = options
+
+        self.callbacks = {}
+        for stage, fns in (callbacks or {}).items():
+            for fn in (fns if isinstance(fns, (list, tuple)) else [fns]):
+                self.addCallback(stage, fn)
+
+        # process the configuration file and load needed modules whos location is based on
+        # the configuration
+        self.configFile = os.path.abspath(configfile)
+        if(not os.path.exists(self.configFile)):
+            raise ImageBuildError("The given config file: '%s', does not exist!" % self.configFile)
+
+        self.config = readConfigFile(self.configFile)
+        self.imageToolDir = os.path.dirname(os.path.realpath(__file__))
+
+        self.pak = None
+        self.out = None
+        self.sbeToolsTar = None
+        self.sbeToolsExtracted = None
+        self.binariesDir = ''
+        self.binaries = {}
+        self.overrides = {}
+        self.perf = perfHistory.PerfRecorder(os.path.basename(self.configFile))
+
+        # Warm state for incremental builds: input digest of each finished
+        # section and every input file resolved by the last build
+        self.builtSections = {}
+        self.inputFiles = set()
+        self.rebuiltSections = []
+        self.prepared = False
+
+        # Every tool started takes a job slot first, from the job server all
+        # builders of the process share, see jobServer.py
+        self.jobs = sharedJobServer(self.args.jobs)
+        try:
+            limitCommand(['true'], self.args.max_memory)
+        except ValueError as e:
+            raise ImageBuildError(f"ERROR: --max-memory: {e}")
 
-    archive.save()
+        self.sectionCache = None
+        if self.args.cache_url:
+            self.sectionCache = RemoteCache(self.args.cache_url,
+                                            upload=not self.args.no_cache_upload)
 
-def stub_cp(src, dir):
-    os.makedirs(dir,exist_ok=True)
-    for f in src.values():
-        cmd = "cp %s %s/" % (f,dir)
-        resp = subprocess.run(cmd.split())
+        # Reproducible builds: timestamps come from SOURCE_DATE_EPOCH and the
+        # tools run with a fixed locale and timezone
+        self.epoch = None
+        if self.args.reproducible:
+            try:
+                self.epoch = int(os.environ.get('SOURCE_DATE_EPOCH', '0'))
+            except ValueError:
+                raise ImageBuildError("ERROR: SOURCE_DATE_EPOCH must be a number of seconds, "
+                                      f"not '{os.environ['SOURCE_DATE_EPOCH']}'")
+
+        # Extracted archives shared with the other builds of the host
+        self.extractCache = sharedCache.SharedCache(self.args.shared_cache)
+        self.workspaceLock = None
+        self.failed = False
+
+        self.testCache = None
+        if self.args.sbe_test_cache:
+            self.testCache = testResults.TestResultCache(self.args.sbe_test_cache)
+
+        self._setupPaths()
+
+    def addCallback(self, stage, fn):
+        if stage != '*' and stage not in self.STAGES:
+            raise ValueError(f"Unknown stage '{stage}'")
+        self.callbacks.setdefault(stage, []).append(fn)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        for fn in self.callbacks.get(name, []) + self.callbacks.get('*', []):
+            fn(self, name, 'start')
+        try:
+            with self.perf.stage(name) as entry:
+                yield entry
+        except BaseException:
+            for fn in self.callbacks.get(name, []) + self.callbacks.get('*', []):
+                fn(self, name, 'error')
+            raise
+        for fn in self.callbacks.get(name, []) + self.callbacks.get('*', []):
+            fn(self, name, 'end')
+
+    def _setupPaths(self):
+        args = self.args
+        config = self.config
+
+        # Get the architecture that's running.
+        resp = subprocess.run(["uname","-m"],stdout=subprocess.PIPE)
+        exe_arch = resp.stdout.decode('utf-8').rstrip()
+
+        # Get the target architecture if available
+        self.target_arch = os.environ.get("ECMD_ARCH")
+        if not self.target_arch:
+            self.target_arch = exe_arch
+
+        self.output = os.path.abspath(args.output)
+        os.makedirs(self.output,exist_ok=True)
+
+        if args.ekb and args.ekb_images:
+            raise ImageBuildError("ERROR Can't use --ekb and --ekb_images together.")
+
+        if not args.ekb and not args.ekb_images and not args.ovrd and not args.build_workdir:
+            raise ImageBuildError("ERROR Needs to specify either --ekb or --ekb_images or --ovrd or --build_workdir")
+
+        if args.build and not args.ekb and not args.build_workdir:
+            raise ImageBuildError("ERROR --build requires --ekb or --build_workdir")
+
+        ## ekb base
+        ekbBase = args.ekb
+        self.ekbImageDir = ''
+
+        if ekbBase:
+            ekbBase = os.path.realpath(os.path.expanduser(ekbBase))
+            ekbImageDir = config['ekbImageSubDir'].replace('%machine_arch%',self.target_arch)
+            self.ekbImageDir = os.path.join(ekbBase,ekbImageDir)
+        else:
+            if args.ekb_images:
+                ekbBase = args.ekb_images
+            elif args.build_workdir:
+                ekbBase = os.path.abspath(os.path.join(args.build_workdir, 'ekb'))
+            else:
+                ekbBase = args.ovrd
+
+            ekbBase = os.path.realpath(os.path.expanduser(ekbBase))
+            self.ekbImageDir = ekbBase
+        self.ekbBase = ekbBase
+
+        ## sbe base
+        sbeBase = args.sbe
+        if not sbeBase:
+            if args.build_workdir:
+                sbeBase = os.path.abspath(os.path.join(args.build_workdir, 'sbe'))
+            elif 'sbeRoot' in config.keys():
+                sbeBase = config['sbeRoot']
+            else:
+                raise ImageBuildError("Critical! No path to sbe repository")
+
+        self.sbeBase = os.path.realpath(os.path.expanduser(sbeBase))
+        self.sbeImageDir = os.path.join(self.sbeBase,'images')
+
+        # Images are built in the workspace and published into output once done
+        if self.workspaceLock is None:
+            self._setupWorkspace()
+        self.outputImagefile = os.path.join(self.output,args.name)
+        self.imagefile = os.path.join(self.workDir,args.name)
+        self.singleImagefile = self.imagefile
+        self.concatCopies = 0
+        if 'concat' in config.keys():
+            self.concatCopies = config['concat']
+        if self.concatCopies > 1:
+            self.singleImagefile = os.path.join(self.workDir,"single_" + args.name)
+        self.eccImagefile = self.imagefile+'.ecc'
+        self.debugTarfile = None
+
+        self.genDir = os.path.join(self.workDir,'gen')
+        self.mergedDir = os.path.join(self.genDir,self.stage1)
+        self.signedDir = os.path.join(self.genDir,self.stage2)
+        self.finalDir  = os.path.join(self.genDir,self.stage3)
+
+    def _setupWorkspace(self):
+        # Scratch space of this build only: gen directory, binaries, images
+        args = self.args
+        if args.workspace:
+            self.workDir = os.path.abspath(os.path.expanduser(args.workspace))
+            os.makedirs(self.workDir, exist_ok=True)
+            self.tempWorkspace = False
+        else:
+            root = os.path.join(self.output, 'workspaces')
+            os.makedirs(root, exist_ok=True)
+            self.workDir = tempfile.mkdtemp(prefix=time.strftime('%Y%m%d-%H%M%S-'), dir=root)
+            self.tempWorkspace = True
 
-def download(url, dir):
-    os.makedirs(dir,exist_ok=True)
-    cmd = f"wget {url} -P {dir}"
-    print(cmd)
-    resp = subprocess.run(cmd.split())
-    if resp.returncode != 0:
-        print(f"{cmd} failed with rc {resp.returncode}")
-        sys.exit(resp.returncode)
-    return os.path.join(dir,os.path.basename(url))
+        self.workspaceLock = open(os.path.join(self.workDir, '.lock'), 'a')
+        try:
+            fcntl.flock(self.workspaceLock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.workspaceLock.close()
+            self.workspaceLock = None
+            raise ImageBuildError(f"ERROR: workspace {self.workDir} is in use by another build")
+
+    def close(self):
+        """Release the workspace. A temporary workspace is removed, unless the
+        last build failed or --keep_workspace is given."""
+        if self.workspaceLock is None:
+            return
+        self.workspaceLock.close()
+        self.workspaceLock = None
+        self.extractCache.close()
+        if self.tempWorkspace:
+            if self.args.keep_workspace or self.failed:
+                print(f"INFO: workspace kept in {self.workDir}")
+            else:
+                shutil.rmtree(self.workDir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    ############################################################
+    # Inputs
+    ############################################################
+
+    def setupRepository(self, basePath, commit, remote):
+        args = self.args
+        print("basePath: %s" % basePath)
+        if not os.path.exists(basePath):
+            if not args.no_downloads:
+                #Download repo
+                print("git repo %s does not exist. Attempting to clone it" % basePath)
+                basePath=basePath.rstrip('/')
+                (dir,repo_name) = os.path.split(basePath)
+                os.makedirs(dir,exist_ok=True)
+                print("cwd: %s  repo: %s" % (dir,repo_name))
+                cmd = 'git clone -b %s ssh://gerrit-server/%s %s -o gerrit' % (commit, remote, repo_name)
+                print(cmd)
+                resp = self.subprocessRun(cmd.split(), cwd=dir)
+                if resp.returncode != 0:
+                    raise ImageBuildError("git clone failed with rc %d" % resp.returncode)
 
-def downloadBinaries(output):
-    cwd = os.getcwd()
-    binariesDir=os.path.join(output,"binaries")
-    if os.path.exists(binariesDir):
-        shutil.rmtree(binariesDir)
-    os.makedirs(binariesDir)
-    downloads = os.path.join(output,"downloads")
-    if os.path.exists(downloads):
-        shutil.rmtree(downloads)
-    os.makedirs(downloads)
-    if 'binaries' in config.keys():
-        repoName = "released"
-        repoPath = os.path.join(downloads,repoName)
-        os.chdir(downloads)
-        cmds=config['binaries']['repository']
-        for cmd in cmds:
-            if cmd.startswith('git clone'):
-                cmd = f"{cmd} {repoName}"
-            print(cmd)
-            resp=subprocess.run(cmd.split())
-            if resp.returncode != 0:
-                os.chdir(cwd)
-                print(f"ERROR: {cmd} failed with rc {resp.returncode}")
-                sys.exit(resp.returncode)
-
-        os.chdir(repoName)
-        # get base commit id
-        cmd = f"git log --oneline -n 1"
-        resp=subprocess.run(cmd.split(),stdout=subprocess.PIPE)
-        baseCommit = resp.stdout.decode().split()[0]
-        if resp.returncode != 0:
-            os.chdir(cwd)
-            print(f"ERROR: {cmd} failed with rc {resp.returncode}")
-            sys.exit(resp.returncode)
-
-        files = config['binaries']['files']
-        for file,commit in files:
-            if commit == '':
-                commit = baseCommit
-            cmd = f"git checkout {commit}"
-            print(f"INFO: {cmd}")
-            resp=subprocess.run(cmd.split(),stderr=subprocess.PIPE)
-            if resp.returncode != 0:
-                print(f"ERROR: {cmd} failed with rc {resp.returncode}")
-                os.chdir(cwd)
-                sys.exit(resp.returncode)
-
-            srcpath=os.path.join(repoPath,file)
-            dstpath=os.path.join(binariesDir,os.path.basename(file))
-            cmd = f"cp {srcpath} {dstpath}"
-            resp=subprocess.run(cmd.split())
+        if not os.path.exists(os.path.join(basePath,'.git')):
+            raise ImageBuildError("%s is not a git repositry" % basePath)
+
+        if not args.nobranchchange:
+            resp = self.subprocessRun(["git","checkout",commit],stdout=subprocess.PIPE,
+                                      cwd=basePath)
             if resp.returncode != 0:
-                print(f"ERROR: {cmd} failed with rc {resp.returncode}")
-                os.chdir(cwd)
-                sys.exit(resp.returncode)
-        os.chdir(cwd)
-    else:
-        os.makedirs(binariesDir,exist_ok=True)
-
-    if os.path.exists(downloads):
-        shutil.rmtree(downloads)
-
-    # create binaries map
-    binaries = {}
-    files = os.listdir(binariesDir)
-    for f in files:
-        fullpath= os.path.join(binariesDir,f)
-        if os.path.isfile(fullpath):
-            binaries[f] = fullpath
-    return (binariesDir,binaries)
-
-def resolveFile(fpath, replacement_tags, overrides, binaries):
-    # replace tags
-    for key,value in replacement_tags.items():
-        fpath = fpath.replace(key,value)
-    # First look for the file in the overrides
-    # If not there then check fpath
-    # If not there then look in binaries
-    fname =  os.path.basename(fpath)
-    if fname in overrides.keys():
-        newPath = overrides[fname]
-    elif os.path.exists(fpath):
-        newPath = fpath
-    elif fname in binaries.keys():
-        newPath = binaries[fname]
-    else:
-        print(f"ERROR Required file not found: {fname}")
-        sys.exit(1)
-
-    tgzext = '.tar.gz'
-    if newPath.endswith(tgzext):
-        # untar tar -C binaries -xzf binaries/sbe_images/odyssey_dd1_0/golden/golden_odyssey_nor_DD1.img.tar.gz
-        tar = tarfile.open(newPath)
-        # TODO might want to consider case where newPath is in an unwriteable location
-        if 'filter' in inspect.signature(tarfile.TarFile.extractall).parameters:
-            tar.extractall(os.path.dirname(newPath),filter="data")
+                raise ImageBuildError("git checkout had returncode %d" % resp.returncode)
+            if args.update:
+                if 'sbe' in remote:
+                    cmds = ['git pull']
+                elif 'ekb' in remote:
+                    cmds = ['git fetch gerrit', 'git rebase gerrit/%s' % (commit)]
+                else:
+                    raise ImageBuildError('Unknown remote: %s' % remote)
+                for cmd in cmds:
+                    print(cmd)
+                    resp = self.subprocessRun(cmd.split(), cwd=basePath)
+                    if resp.returncode != 0:
+                        raise ImageBuildError("git update failed with rc %d" % resp.returncode)
+
+        if 'sbe' in remote:
+            cmd= self.config['sbeWorkon']
+            build_cmd=self.config['sbeBuild']
+            if (args.devready or args.devreadysbe):
+                if not args.nobranchchange:
+                    self.getDevReadyCommits('sbe', commit, basePath)
+                else:
+                    print("Not getting dev-ready updates because --nobranchchange was specified")
+
+        elif 'ekb' in remote:
+            cmd= self.config['ekbWorkon']
+            build_cmd= self.config['ekbBuild']
+            if (args.devready or args.devreadyekb):
+                if not args.nobranchchange:
+                    self.getDevReadyCommits('ekb', commit, basePath)
+                else:
+                    print("Not getting dev-ready updates because --nobranchchange was specified")
         else:
-            tar.extractall(os.path.dirname(newPath))
-        newPath=newPath[:-len(tgzext)]
-    print(f"INFO: Using {newPath}")
-    return newPath
+            raise ImageBuildError('Unknown remote: %s' % remote)
+
+        # The build's own make joins the jobserver through the inherited fds
+        with self.popen(cmd.split(),stdin=subprocess.PIPE,cwd=basePath) as proc:
+            self.communicate(proc, str.encode(build_cmd))
+            if proc.returncode != 0:
+                raise ImageBuildError("Building %s had a returncode %d" % (
+                    basePath,
+                    proc.returncode))
+
+    def getDevReadyCommits(self, repo, commit, basePath):
+        print("\nRunning ./", repo, " cronus checkout")
+        if (repo == 'sbe'):
+            dev_out_file = 'cro_ody_sbe_image_cronus_checkout.sversion'
+            with self.popen(['export PROJECT_NAME=sbe; export SBEROOT=`pwd` export SBEROOT_INT=`pwd`/internal; export SBE_INSIDE_WORKON=1; source ./internal/projectrc; ./sbe cronus_devready checkout; unset SBE_INSIDE_WORKON; unset PROJECT_NAME; unset SBEROOT; unset SBEROOT_INT;'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, universal_newlines=True, cwd=basePath) as proc:
+                dev_out, err = self.communicate(proc)
+        else:
+            dev_out_file = 'cro_ody_ekb_image_cronus_checkout.sversion'
+            with self.popen(['source ./env.bash; ./ekb cronus checkout --branch', commit], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, universal_newlines=True, cwd=basePath) as proc:
+                dev_out, err = self.communicate(proc)
+        # Sometimes seeing stuff in stderr that isn't actually an error, so not going to fail
+        if err:
+            print("INFO: stderr returned:\n", err)
+
+        print(repo, " cronus checkout --branch", commit, "\n")
+        print(dev_out)
+
+        # look for explicit problems
+        if ('Outstanding tracked changes' or 'Not a git repository' or 'Run this tool from the root' or 'Cherry-picks failed') in dev_out:
+            raise ImageBuildError("ERROR! Failed checking of dev-ready checkouts\n%s" % dev_out)
+
+        # look for confirmation it worked
+        if not ('Checking out' and 'All Cherry-picks applied cleanly') in dev_out:
+            raise ImageBuildError("ERROR! Failed checking out dev-ready checkouts\n%s" % dev_out)
+
+        # write output to a file
+        filename = os.path.join(self.output, dev_out_file)
+        tmpPath = tempPath(filename)
+        with open(tmpPath, 'w') as outfile:
+            outfile.write(dev_out)
+        os.replace(tmpPath, filename)
+
+    def loadOverrides(self):
+        self.overrides = {}
+        if self.args.ovrd:
+            path = os.path.realpath(os.path.expanduser(self.args.ovrd))
+            if os.path.exists(path):
+                files = sorted(os.listdir(path))
+                for f in files:
+                    fullpath = os.path.join(path,f)
+                    if os.path.isfile(fullpath):
+                        self.overrides[f] = fullpath
+            else:
+                print("WARN override directory does not exist: %s" % path)
+        return self.overrides
+
+    def downloadBinaries(self):
+        config = self.config
+        binariesDir=os.path.join(self.workDir,"binaries")
+        if os.path.exists(binariesDir):
+            shutil.rmtree(binariesDir)
+        os.makedirs(binariesDir)
+        downloads = os.path.join(self.workDir,"downloads")
+        if os.path.exists(downloads):
+            shutil.rmtree(downloads)
+        os.makedirs(downloads)
+        if 'binaries' in config.keys():
+            repoName = "released"
+            repoPath = os.path.join(downloads,repoName)
+            cmds=config['binaries']['repository']
+            for cmd in cmds:
+                if cmd.startswith('git clone'):
+                    cmd = f"{cmd} {repoName}"
+                print(cmd)
+                resp=self.subprocessRun(cmd.split(),cwd=downloads)
+                if resp.returncode != 0:
+                    raise ImageBuildError(f"ERROR: {cmd} failed with rc {resp.returncode}", resp.returncode)
 
+            # get base commit id
+            cmd = f"git log --oneline -n 1"
+            resp=self.subprocessRun(cmd.split(),stdout=subprocess.PIPE,cwd=repoPath)
+            if resp.returncode != 0:
+                raise ImageBuildError(f"ERROR: {cmd} failed with rc {resp.returncode}", resp.returncode)
+            baseCommit = resp.stdout.decode().split()[0]
+
+            files = config['binaries']['files']
+            for file,commit in files:
+                if commit == '':
+                    commit = baseCommit
+                cmd = f"git checkout {commit}"
+                print(f"INFO: {cmd}")
+                resp=self.subprocessRun(cmd.split(),stderr=subprocess.PIPE,cwd=repoPath)
+                if resp.returncode != 0:
+                    raise ImageBuildError(f"ERROR: {cmd} failed with rc {resp.returncode}", resp.returncode)
+
+                srcpath=os.path.join(repoPath,file)
+                dstpath=os.path.join(binariesDir,os.path.basename(file))
+                try:
+                    # Each file may come from a different commit, so take a copy
+                    # of this checkout's content rather than a link
+                    copyFile(srcpath, dstpath)
+                except OSError as e:
+                    raise ImageBuildError(f"ERROR: copy of {srcpath} failed: {e}")
+        else:
+            os.makedirs(binariesDir,exist_ok=True)
 
-############################################################
-# Main - Main - Main - Main - Main - Main - Main - Main
-############################################################
+        if os.path.exists(downloads):
+            shutil.rmtree(downloads)
 
-imageToolDir = os.path.dirname(sys.argv[0])
-parser = argparse.ArgumentParser(description="Build image",
-                                 formatter_class=argparse.RawDescriptionHelpFormatter,
-                                 epilog=textwrap.dedent('''
-
-examples:
-  > imageBuild.py configs/odyssey/dd1/ody_pnor_dd1_image_config -o ./image_output -n pnor.bin
-'''))
-
-parser.add_argument('configfile',
-                    help="The configuration file used to build the image.")
-parser.add_argument('-b','--build',action='store_true',
-                    help='Downloads ekb and sbe repositories (if not found), '
-                    'then checks out branchs and builds them. Note: Requires '
-                    ' --ekb and --sbe, or --build_workdir')
-parser.add_argument('--nobranchchange', action='store_true',
-                    help="Don't change the branch when building")
-parser.add_argument('--update', action='store_true',
-                    help='After changing to specified branch, '
-                    'update it from the server as well')
-parser.add_argument('--devready', action='store_true',
-                    help='Apply dev-ready ekb and sbe commits on top of branch')
-parser.add_argument('--devreadyekb', action='store_true',
-                    help='Apply dev-ready ekb commits on top of branch')
-parser.add_argument('--devreadysbe', action='store_true',
-                    help='Apply dev-ready sbe commits on top of branch')
-parser.add_argument('--ekb',default=None,
-                    help='Base path of the ekb git repository.'
-                    ' Use --ekb_images instead for pre-built images')
-parser.add_argument('--ekb_images',default=None,
-                    help='Image directory of pre-built ekb images.')
-parser.add_argument('--sbe',default=None,
-                    help='Base path of sbe repository or sbe images. Default: use value '
-                    'in configfile')
-parser.add_argument('--ovrd',default=None,
-                    help='Directory to look for override source files.'
-                    ' Files must have same name as those being overridden')
-parser.add_argument('-o','--output', default='./image_output',
-                    help='output directory. default ./image_output')
-parser.add_argument('-n','--name', default='image.bin',
-                    help='output image filename. default: image.bin')
-parser.add_argument('--pakToolDir',default=None,
-                    help='Directory of PAK tools. '
-                    'PAK tool override. Only required if PAK tools not available in '
-                    'ekb,sbe,or sbe_tools.')
-parser.add_argument('--sbe_test',action='store_true',
-                    help='Run sbe test cases to validate the images')
-parser.add_argument('--build_workdir', type=str,
-                    help='Work directory for the build. '
-                    'Tool will ignore xxxxRoot configure parameter value.')
-parser.add_argument('--buildGoldenImg', type=int, metavar="SIDE_COUNT",
-                    help='Use to build golden image with the side count '
-                         'instead of the configured frozen golden image.'
-                         'The golden image will be used for the given sides.')
-parser.add_argument('--allowToSign', action='store_true',
-                    help='Use to allow the signing process for the frozen '
-                         'configured image_sections.')
-parser.add_argument('--no_downloads', action='store_true',
-                    help='Disable downloading any repositories/binaries etc.')
-parser.add_argument('--disable_arch_nor_img', action='store_true',
-                    help='disable nor image copy into debug archive')
-args = parser.parse_args()
-
-# process the configuration file and load needed modules whos location is based on
-# the configuration
-configFile = os.path.abspath(args.configfile)
-if(not os.path.exists(configFile)):
-    print("The given config file: '%s', does not exist!" % configFile, file=sys.stderr)
-    sys.exit(1)
-
-cwd = os.getcwd()
-
-configdir = os.path.dirname(configFile)
-
-config = readConfigFile(configFile)
-
-# Get the architecture that's running.
-resp = subprocess.run(["uname","-m"],stdout=subprocess.PIPE)
-exe_arch = resp.stdout.decode('utf-8').rstrip()
-
-# Get the target architecture if available
-target_arch = os.environ.get("ECMD_ARCH")
-if not target_arch:
-    target_arch = exe_arch
-
-output    = os.path.abspath(args.output)
-os.makedirs(output,exist_ok=True)
-
-if args.ekb and args.ekb_images:
-    print("ERROR Can't use --ekb and --ekb_images together.")
-    sys.exit(1)
-
-if not args.ekb and not args.ekb_images and not args.ovrd and not args.build_workdir:
-    print("ERROR Needs to specify either --ekb or --ekb_images or --ovrd or --build_workdir")
-    sys.exit(1)
-
-if args.build and not args.ekb and not args.build_workdir:
-    print("ERROR --build requires --ekb or --build_workdir")
-    sys.exit(1)
-
-## ekb base
-ekbBase = args.ekb
-ekbImageDir = ''
-
-if ekbBase:
-    ekbBase = os.path.realpath(os.path.expanduser(ekbBase))
-    ekbImageDir = config['ekbImageSubDir'].replace('%machine_arch%',target_arch)
-    ekbImageDir = os.path.join(ekbBase,ekbImageDir)
-else:
-    if args.ekb_images:
-        ekbBase = args.ekb_images
-    elif args.build_workdir:
-        ekbBase = os.path.abspath(os.path.join(args.build_workdir, 'ekb'))
-    else:
-        ekbBase = args.ovrd
-
-    ekbBase = os.path.realpath(os.path.expanduser(ekbBase))
-    ekbImagDir = ekbBase
-
-## sbe base
-sbeBase = args.sbe
-if not sbeBase:
-    if args.build_workdir:
-        sbeBase = os.path.abspath(os.path.join(args.build_workdir, 'sbe'))
-    elif 'sbeRoot' in config.keys():
-        sbeBase = config['sbeRoot']
-    else:
-        print("Critical! No path to sbe repository")
-        sys.exit(1)
-
-sbeBase = os.path.realpath(os.path.expanduser(sbeBase))
-sbeImageDir = os.path.join(sbeBase,'images')
-
-# setup git repos and build - only if --build option specified.
-if args.build:
-    setupRepository(ekbBase, config['ekbCommit'],'hw/ekb-src')
-    setupRepository(sbeBase, config['sbeCommit'],'hw/sbe')
-os.chdir(cwd)
-
-## Load overrides
-overrides = {}
-if args.ovrd:
-    path = os.path.realpath(os.path.expanduser(args.ovrd))
-    if os.path.exists(path):
-        files = os.listdir(path)
+        # create binaries map
+        binaries = {}
+        files = sorted(os.listdir(binariesDir))
         for f in files:
-            fullpath = os.path.join(path,f)
+            fullpath= os.path.join(binariesDir,f)
             if os.path.isfile(fullpath):
-                overrides[f] = fullpath
-    else:
-        print("WARN override directory does not exist: %s" % path)
-
-## Load released binaries
-binariesDir = ''
-binaries = {}
-if not args.no_downloads:
-    binariesDir,binaries = downloadBinaries(output)
-
-# Untar sbe_tools.tar.gz to get sbe tools
-sbeToolsTar = config['sbeTools']
-if(sbeToolsTar in overrides.keys()):
-    sbeToolsTar = overrides[sbeToolsTar]
-else:
-    sbeToolsTar = os.path.join(sbeImageDir, sbeToolsTar)
-
-sbeTools = tarfile.open(sbeToolsTar)
-
-if 'filter' in inspect.signature(tarfile.TarFile.extractall).parameters:
-    sbeTools.extractall(output,filter="data")
-else:
-    sbeTools.extractall(output)
-
-sbeToolsDir = os.path.join(output,'sbe_tools')
-sbeImageTool = os.path.join(sbeToolsDir, 'imageTool.py')
-
-ARCH = platform.machine()
-sbeEccTool = os.path.join(sbeToolsDir,'ecc') + '_' + ARCH
-if not os.path.exists(sbeEccTool):
-    sbeEccTool = os.path.join(sbeToolsDir,'ecc')
-    if not os.path.exists(sbeEccTool):
-        print("ERROR: %s does not exist. Make sure SBE is current" % sbeEccTool)
-        sys.exit(1)
-
-
-## pak tools
-pakToolsDir = args.pakToolDir
-if(pakToolsDir):
-    pakToolsDir = os.path.realpath(os.path.expanduser(pakToolsDir))
-else:
-    # First, look in sbe tools
-    # TODO where under sbeToolsDir will pak tools be?
-    pakToolsDir = os.path.join(sbeToolsDir,'tools')
-if not os.path.exists(os.path.join(pakToolsDir,'paktool')):
-    # Next, look in sbe path
-    pakToolsDir = os.path.join(sbeBase,'public','src','import','public',
-                               'common','utils','imageProcs','tools')
-if not os.path.exists(pakToolsDir):
-    # Finally, look in ekb path
-    pakToolsDir = os.path.join(ekbBase,'public','common','utils',
-                               'imageProcs','tools')
-    if not os.path.exists(pakToolsDir):
-        print("ERROR:  Can't find paktools")
-        sys.exit(1)
-
-imageToolDir = os.path.realpath(os.path.expanduser(imageToolDir))
-pakTool         = os.path.join(pakToolsDir, 'paktool')
-flashBuildTool  = os.path.join(pakToolsDir, 'flashbuild')
-
-
-imagefile = os.path.join(output,args.name)
-singleImagefile = imagefile
-concatCopies = 0
-if 'concat' in config.keys():
-    concatCopies = config['concat']
-if concatCopies > 1:
-    singleImagefile = os.path.join(output,"single_" + args.name)
-
-if os.path.exists(imagefile):
-    os.remove(imagefile)
-if os.path.exists(singleImagefile):
-    os.remove(singleImagefile)
-
-genDir = os.path.join(output,'gen')
-if os.path.exists(genDir):
-    shutil.rmtree(genDir)
-os.makedirs(genDir)
-
-# Required before calling pak tools
-sys.path.append("%s/pymod" % pakToolsDir)
-
-from output import out
-import pakcore as pak
-
-#only print out critical errors. For debug, change CRITICAL to DEBUG
-out.setConsoleLevel(out.levels.CRITICAL)
-
-section_info = config['image_sections']
-
-#### Build stages
-####    Note : Below stage will be skipped if section is configured with 'signed_image'
-####           and '--allowToSign' option is not passed since the SBE provides
-####           frozen signed images so tool should not attempt to sign.
-stage1 = 'merged'
-stage2 = 'signed'
-stage3 = 'final'  #hashed
-
-mergedDir = os.path.join(genDir,stage1)
-signedDir = os.path.join(genDir,stage2)
-finalDir  = os.path.join(genDir,stage3)
-
-os.makedirs(mergedDir,exist_ok=True)
-os.makedirs(signedDir,exist_ok=True)
-os.makedirs(finalDir,exist_ok=True)
-
-#
-replacement_tags = {
-        '%binariesDir%'  : binariesDir,
-        '%imageToolDir%' : imageToolDir,
-        '%ekbImageDir%' : ekbImageDir,
-        '%sbeImageDir%' : sbeImageDir,
-        '%sbeRoot%'     : sbeBase,
-        '%gen%'         : genDir,
-}
-
-# Discover partitions
-partitions = []
-for sectionName, info in section_info.items():
-    partitions.append((sectionName, info['partition_size']))
-
-# Create partitions file and build partition table
-partitionsfile = buildPartitionTable(partitions)
-
-# Resolve archive paths in image_sections
-# Merge archives where more than one exists in an image section
-for sectionName, info in section_info.items():
-    if 'signed_image' in info.keys() and not args.allowToSign:
-        print(f"INFO: Use configured signed image for '{sectionName}' so no signing...")
-        continue
-
-    archives    = []
-    baseEntries = []
-
-    # Resolve location of archive images
-    for arc in info['archives']:
-
-        arc = resolveFile(arc, replacement_tags, overrides, binaries)
-        archives.append(arc)
-
-    if 'files' in info.keys():
-        for (entryName,entryPath) in info['files']:
-            for key,value in replacement_tags.items():
-                entryPath = entryPath.replace(key,value)
-            baseEntries.append((entryName,entryPath))
-
-    # merge archives
-    section_info[sectionName]['mergedArchive'] = mergeArchives(sectionName, archives, baseEntries)
-
-
-# Add signature/hash to sections that require it
-signImgSrc = {}
-hashImgSrc = {}
-asisImgSrc = {}
+                binaries[f] = fullpath
+        self.binariesDir = binariesDir
+        self.binaries = binaries
+        return (binariesDir,binaries)
+
+    def replaceTags(self, fpath):
+        for key,value in self.replacement_tags.items():
+            fpath = fpath.replace(key,value)
+        return fpath
+
+    def resolveFile(self, fpath):
+        # replace tags
+        fpath = self.replaceTags(fpath)
+        # First look for the file in the overrides
+        # If not there then check fpath
+        # If not there then look in binaries
+        fname =  os.path.basename(fpath)
+        if fname in self.overrides.keys():
+            newPath = self.overrides[fname]
+        elif os.path.exists(fpath):
+            newPath = fpath
+        elif fname in self.binaries.keys():
+            newPath = self.binaries[fname]
+        else:
+            raise ImageBuildError(f"ERROR Required file not found: {fname}")
+        self.inputFiles.add(newPath)
+
+        tgzext = '.tar.gz'
+        if newPath.endswith(tgzext):
+            # e.g. golden_odyssey_nor_DD1.img.tar.gz holds golden_odyssey_nor_DD1.img.
+            # Extracted once into the shared cache, never next to the source
+            extracted = self.extractCache.extract(newPath, extractTar)
+            newPath = os.path.join(extracted, os.path.basename(newPath)[:-len(tgzext)])
+        print(f"INFO: Using {newPath}")
+        return newPath
+
+    ############################################################
+    # Tools
+    ############################################################
+
+    def resolveTools(self):
+        """Extract sbe_tools, find paktool/flashbuild/ecc and import pakcore.
+        Done again whenever the content of sbe_tools.tar.gz changes."""
+        # Untar sbe_tools.tar.gz to get sbe tools
+        sbeToolsTar = self.config['sbeTools']
+        if(sbeToolsTar in self.overrides.keys()):
+            sbeToolsTar = self.overrides[sbeToolsTar]
+        else:
+            sbeToolsTar = os.path.join(self.sbeImageDir, sbeToolsTar)
+
+        if not os.path.exists(sbeToolsTar):
+            raise ImageBuildError(f"ERROR: {sbeToolsTar} does not exist")
+        self.sbeToolsTar = sbeToolsTar
+        # Named by the digest of the archive, so it changes with its content
+        extracted = self.extractCache.extract(sbeToolsTar, extractTar)
+        if self.pak is not None and extracted == self.sbeToolsExtracted:
+            return
+        sbeToolsDir = os.path.join(extracted, 'sbe_tools')
+
+        ARCH = platform.machine()
+        sbeEccTool = os.path.join(sbeToolsDir,'ecc') + '_' + ARCH
+        if not os.path.exists(sbeEccTool):
+            sbeEccTool = os.path.join(sbeToolsDir,'ecc')
+            if not os.path.exists(sbeEccTool):
+                raise ImageBuildError("ERROR: %s does not exist. Make sure SBE is current" % sbeEccTool)
+
+        ## pak tools
+        pakToolsDir = self.args.pakToolDir
+        if(pakToolsDir):
+            pakToolsDir = os.path.realpath(os.path.expanduser(pakToolsDir))
+        else:
+            # First, look in sbe tools
+            # TODO where under sbeToolsDir will pak tools be?
+            pakToolsDir = os.path.join(sbeToolsDir,'tools')
+        if not os.path.exists(os.path.join(pakToolsDir,'paktool')):
+            # Next, look in sbe path
+            pakToolsDir = os.path.join(self.sbeBase,'public','src','import','public',
+                                       'common','utils','imageProcs','tools')
+        if not os.path.exists(pakToolsDir):
+            # Finally, look in ekb path
+            pakToolsDir = os.path.join(self.ekbBase,'public','common','utils',
+                                       'imageProcs','tools')
+            if not os.path.exists(pakToolsDir):
+                raise ImageBuildError("ERROR:  Can't find paktools")
+
+        # Required before calling pak tools. pakcore imports its siblings by
+        # name, so a process can only load the pak modules once. Another copy
+        # with the same content (e.g. a new sbe_tools that only changed other
+        # tools) keeps using the loaded ones.
+        pymod = "%s/pymod" % pakToolsDir
+        loaded = sys.modules.get('pakcore')
+        if loaded is not None:
+            loadedDir = os.path.dirname(os.path.realpath(loaded.__file__))
+            if loadedDir != os.path.realpath(pymod) and treeDigest(loadedDir) != treeDigest(pymod):
+                raise ImageBuildError(f"ERROR: pakcore is already loaded from {loadedDir}, the pak "
+                                      f"modules in {pymod} differ and can't be loaded in the same "
+                                      f"process. Restart imageBuild.py to use them")
+        if pymod not in sys.path:
+            sys.path.append(pymod)
+
+        self.out = importlib.import_module('output').out
+        self.pak = importlib.import_module('pakcore')
+
+        #only print out critical errors. For debug, change CRITICAL to DEBUG
+        self.out.setConsoleLevel(self.out.levels.CRITICAL)
+
+        if self.sbeToolsExtracted is not None:
+            print(f"INFO: Using the tools of the changed {sbeToolsTar}")
+        self.sbeToolsExtracted = extracted
+        self.sbeImageTool    = os.path.join(sbeToolsDir, 'imageTool.py')
+        self.sbeEccTool      = sbeEccTool
+        self.pakToolsDir     = pakToolsDir
+        self.pakTool         = os.path.join(pakToolsDir, 'paktool')
+        self.flashBuildTool  = os.path.join(pakToolsDir, 'flashbuild')
+
+        # ./sbe runtest expects sbe_tools in the directory it is given
+        workspaceTools = os.path.join(self.workDir, 'sbe_tools')
+        if os.path.isdir(workspaceTools) and not os.path.islink(workspaceTools):
+            # Extracted there by older versions, when the output directory
+            # is reused as --workspace
+            print(f"INFO: Replacing the extracted {workspaceTools} with a link to the shared cache")
+            shutil.rmtree(workspaceTools)
+        elif os.path.lexists(workspaceTools) and (not os.path.islink(workspaceTools) or
+                                                  os.readlink(workspaceTools) != sbeToolsDir):
+            os.remove(workspaceTools)
+        if not os.path.lexists(workspaceTools):
+            os.symlink(sbeToolsDir, workspaceTools)
+
+        # Tools that change the content of a section without being one of its
+        # inputs. The whole sbe_tools archive counts, signPak imports more of
+        # it than imageTool.py; its digest is the one the tools were
+        # extracted from, not that of the archive as it is now.
+        self.cacheTools = [self.pakTool, self.sbeImageTool]
+        self.cacheToolsExtra = ['sbe_tools=%s' % os.path.basename(extracted)]
+
+    def subprocessRun(self, args, input=None, **kwargs):
+        """subprocess.run() within a job slot"""
+        if input is not None:
+            kwargs['stdin'] = subprocess.PIPE
+        with self.popen(args, **kwargs) as proc:
+            stdout, stderr = self.communicate(proc, input)
+        return subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+
+    @contextlib.contextmanager
+    def popen(self, args, **kwargs):
+        """subprocess.Popen() holding a job slot until the process is done"""
+        if self.epoch is not None:
+            # Taken from os.environ at every start, signSections sets the
+            # signing variables in it after __init__
+            kwargs.setdefault('env', dict(os.environ, SOURCE_DATE_EPOCH=str(self.epoch),
+                                          TZ='UTC', LC_ALL='C'))
+        args, kwargs['shell'] = limitCommand(args, self.args.max_memory, kwargs.get('shell', False))
+        with self.jobs.slot():
+            with subprocess.Popen(args, **self.jobs.popenArgs(), **kwargs) as proc:
+                yield proc
+
+    def communicate(self, proc, input=None):
+        """proc.communicate(), reaping the tool with wait4 to record its own
+        peak memory for the current stage"""
+        output = {}
+        def drain(name, f):
+            output[name] = f.read()
+        readers = [threading.Thread(target=drain, args=(name, f))
+                   for name, f in (('stdout', proc.stdout), ('stderr', proc.stderr))
+                   if f is not None and not f.closed]
+        for t in readers:
+            t.start()
+        if proc.stdin is not None and not proc.stdin.closed:
+            try:
+                if input:
+                    proc.stdin.write(input)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        for t in readers:
+            t.join()
+
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        self.perf.addToolPeak(usage.ru_maxrss)
+        return output.get('stdout'), output.get('stderr')
+
+    def run(self, cmd, errorMsg=None):
+        """Run a tool, raising ImageBuildError with errorMsg % rc on failure"""
+        resp = self.subprocessRun(cmd.split())
+        if resp.returncode != 0:
+            if errorMsg is None:
+                errorMsg = "%s failed with rc %%d" % cmd
+            raise ImageBuildError(errorMsg % resp.returncode, resp.returncode)
+        return resp
+
+    ############################################################
+    # Stages
+    ############################################################
+
+    def prepare(self, incremental=False):
+        """Set up inputs and tools, then start a fresh gen directory.
+        An incremental build keeps the repositories, binaries and gen directory
+        of the previous build."""
+        args = self.args
+
+        self.perf = perfHistory.PerfRecorder(os.path.basename(self.configFile))
+        if args.perf_history:
+            self.perf.inputDigests[os.path.basename(self.configFile)] = fileDigest(self.configFile)
+
+        warm = incremental and self.prepared
+        self.perf.incremental = warm
+        if not warm:
+            self.builtSections = {}
+
+        # setup git repos and build - only if --build option specified.
+        if args.build and not warm:
+            with self.stage('setup'):
+                self.setupRepository(self.ekbBase, self.config['ekbCommit'],'hw/ekb-src')
+                self.setupRepository(self.sbeBase, self.config['sbeCommit'],'hw/sbe')
+
+        ## Load overrides
+        self.loadOverrides()
+
+        ## Load released binaries
+        if not args.no_downloads and not warm:
+            with self.stage('binaries'):
+                self.downloadBinaries()
+
+        with self.stage('tools'):
+            self.resolveTools()
+
+        # The published files are hard links to these, the tools must write
+        # new files rather than into the inodes already in the output directory
+        for path in [self.imagefile, self.singleImagefile, self.eccImagefile, self.debugTarfile]:
+            if path and os.path.exists(path):
+                os.remove(path)
+        self.debugTarfile = None
+
+        if os.path.exists(self.genDir) and not warm:
+            shutil.rmtree(self.genDir)
+        os.makedirs(self.genDir,exist_ok=True)
+
+        os.makedirs(self.mergedDir,exist_ok=True)
+        os.makedirs(self.signedDir,exist_ok=True)
+        os.makedirs(self.finalDir,exist_ok=True)
+
+        #
+        self.replacement_tags = {
+                '%binariesDir%'  : self.binariesDir,
+                '%imageToolDir%' : self.imageToolDir,
+                '%ekbImageDir%' : self.ekbImageDir,
+                '%sbeImageDir%' : self.sbeImageDir,
+                '%sbeRoot%'     : self.sbeBase,
+                '%gen%'         : self.genDir,
+        }
+
+        self.section_info = copy.deepcopy(self.config['image_sections'])
+        self.inputFiles = {self.configFile}
+        self.rebuiltSections = []
+        self.signImgSrc = {}
+        self.hashImgSrc = {}
+        self.asisImgSrc = {}
+        self.notHashed  = {}
+
+    def buildPartitionTable(self):
+        # Discover partitions
+        partitions = []
+        for sectionName, info in self.section_info.items():
+            partitions.append((sectionName, info['partition_size']))
+
+        # Write the  partitions file
+        self.partitionsfile = os.path.join(self.genDir,'partitions')
+        with open(self.partitionsfile,'w') as f:
+            print(partitions, file=f)
+
+        # Build part.tbl
+        cmd = "%s compile-ptable %s %s/part.tbl" % (
+                self.flashBuildTool,
+                self.partitionsfile,
+                self.genDir)
+        #print(cmd)
+        with self.stage('ptable'):
+            self.run(cmd, "falshBuildTool failed to build part.table. rc = %d")
+
+        return self.partitionsfile
+
+    def mergeArchives(self, sectionName, archiveFileList, baseEntries):
+        pak = self.pak
+        # Create an empty archive for the section
+        mergedArchiveFile = os.path.join(self.mergedDir, sectionName+'.pak')
+        if os.path.exists(mergedArchiveFile): os.remove(mergedArchiveFile)
+        archive = pak.Archive(mergedArchiveFile)
+
+        # Add essential entries
+        for (entryName,entryPath) in baseEntries:
+            entryData = ''.encode()
+            if os.path.exists(entryPath):
+                with open(entryPath, "rb") as f:
+                    entryData = f.read()
+
+            archive.add(entryName, pak.CM.store ,entryData)
+        archive.save()
+
+        # Merge archives
+        if len(archiveFileList) > 0:
+            cmd = "%s merge %s %s" % (self.pakTool, mergedArchiveFile, ' '.join(archiveFileList))
+            self.run(cmd, "ERROR: %s failed with rc %%d" % cmd)
+
+        return mergedArchiveFile
+
+    def mergeSections(self, incremental=False):
+        """Resolve archive paths in image_sections, reuse sections unchanged since
+        the last (incremental) build, fetch unchanged sections from the section
+        cache and merge archives of the others"""
+        args = self.args
+        perf = self.perf
+        cacheExtra = (['opbuild' if os.environ.get('HOST_DIR') else 'rhel', args.allowToSign] +
+                      ['%s=%s' % item for item in sorted(self.signingEnv().items())] +
+                      self.cacheToolsExtra)
+        toMerge = []
+
+        for sectionName, info in self.section_info.items():
+            if 'signed_image' in info.keys() and not args.allowToSign:
+                print(f"INFO: Use configured signed image for '{sectionName}' so no signing...")
+                continue
+
+            archives    = []
+            baseEntries = []
+
+            # Resolve location of archive images
+            with self.stage('resolve'):
+                for arc in info['archives']:
+
+                    arc = self.resolveFile(arc)
+                    archives.append(arc)
+                    perf.addFileBytes('resolve', arc)
+                    if args.perf_history:
+                        perf.inputDigests[os.path.basename(arc)] = fileDigest(arc)
+
+            if 'files' in info.keys():
+                for (entryName,entryPath) in info['files']:
+                    baseEntries.append((entryName,self.replaceTags(entryPath)))
+                    self.inputFiles.add(baseEntries[-1][1])
+
+            if self.sectionCache or incremental:
+                digest = sectionDigest(sectionName, info, archives, baseEntries,
+                                       self.cacheTools, cacheExtra)
+                info['sectionDigest'] = digest
+                cachedArchive = os.path.join(self.finalDir, sectionName+'.pak')
+
+                # Still in the final stage from the last build
+                if (incremental and self.builtSections.get(sectionName) == digest and
+                        os.path.exists(cachedArchive)):
+                    info['finalArchive'] = cachedArchive
+                    perf.reusedSections.append(sectionName)
+                    continue
+
+            # Fetch the finished section from the shared cache when the inputs match
+            if self.sectionCache:
+                if self.sectionCache.fetch(digest, cachedArchive):
+                    print(f"INFO: Using cached '{sectionName}' section {digest[:12]}")
+                    info['finalArchive'] = cachedArchive
+                    perf.reusedSections.append(sectionName)
+                    continue
+
+            toMerge.append((sectionName, archives, baseEntries))
+
+        # merge archives, the sections in parallel as far as job slots allow
+        with self.stage('merge'):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(toMerge))) as pool:
+                merges = [(sectionName, pool.submit(perf.bind(self.mergeArchives), sectionName,
+                                                    archives, baseEntries))
+                          for (sectionName, archives, baseEntries) in toMerge]
+                for sectionName, merge in merges:
+                    info = self.section_info[sectionName]
+                    info['mergedArchive'] = merge.result()
+                    perf.addFileBytes('merge', info['mergedArchive'])
+                    self.rebuiltSections.append(sectionName)
+
+    # Estimated growth of a merged section until it is final. Sections can set
+    # 'size_overhead' in the config to replace the estimate.
+    HASHLIST_ENTRY_OVERHEAD = 64 + 8     # hash + record header, plus the entry name
+    SIGNATURE_OVERHEAD      = 0x1000     # secure container added by signPak
+    IMAGEHASH_OVERHEAD      = 0x100      # image.hash entry added by pakHash
+
+    def estimateSectionSize(self, sectionName, info):
+        """Returns (bytes, exact, known) for the final archive of a section.
+        known is the part of bytes that is not estimated overhead."""
+        if 'mergedArchive' not in info.keys():
+            # Fetched from the cache or a configured signed image, already final
+            path = info.get('finalArchive')
+            if not path and 'signed_image' in info.keys():
+                path = self.replaceTags(info['signed_image'])
+            if path and os.path.exists(path):
+                size = os.path.getsize(path)
+                return (size, True, size)
+            return (None, False, None)
+
+        size = known = os.path.getsize(info['mergedArchive'])
+        if 'size_overhead' in info.keys():
+            return (size + info['size_overhead'], False, known)
+        if 'hashlist' not in info.keys() and 'imagehash' not in info.keys():
+            return (size, True, known)
+
+        if 'hashlist' in info.keys():
+            archive = self.pak.Archive(info['mergedArchive'])
+            archive.load()
+            for entry in archive:
+                size += self.HASHLIST_ENTRY_OVERHEAD + len(entry.name)
+            size += self.SIGNATURE_OVERHEAD
+        if 'imagehash' in info.keys():
+            size += self.IMAGEHASH_OVERHEAD
+        return (size, False, known)
+
+    def checkCapacity(self):
+        """Check that every section fits its partition before the slow signing
+        work, print the capacity table and optionally save it as json"""
+        partitions = []
+        overflow = []
+        maybeOverflow = []
+        with self.stage('fit-check'):
+            for sectionName, info in self.section_info.items():
+                used, exact, known = self.estimateSectionSize(sectionName, info)
+                size = info['partition_size']
+                partitions.append({'name': sectionName, 'size': size, 'used': used,
+                                   'free': None if used is None else size - used,
+                                   'exact': exact})
+                if used is None or used <= size:
+                    continue
+                # Only the built-in overhead constants are guesses, flashbuild
+                # has the last word on those
+                if exact or known > size or 'size_overhead' in info.keys():
+                    overflow.append(sectionName)
+                else:
+                    maybeOverflow.append(sectionName)
+
+        sides = self.concatCopies if self.concatCopies > 1 else 1
+        if self.concatCopies > 1 and self.args.buildGoldenImg:
+            sides = self.args.buildGoldenImg
+        sideSize = sum(p['size'] for p in partitions)
+        sideUsed = sum(p['used'] or 0 for p in partitions)
+        capacity = {
+            'config'     : os.path.basename(self.configFile),
+            'partitions' : partitions,
+            'side'       : {'size': sideSize, 'used': sideUsed, 'free': sideSize - sideUsed},
+            'sides'      : sides,
+            'image'      : {'size': sideSize * sides, 'used': sideUsed * sides,
+                            'free': (sideSize - sideUsed) * sides},
+        }
+
+        print("INFO: Partition capacity (~ estimated until signed)")
+        print("  %-10s %10s %10s %10s %6s" % ('partition', 'size', 'used', 'free', 'used%'))
+        for p in partitions:
+            if p['used'] is None:
+                print("  %-10s %#10x %10s %10s %6s" % (p['name'], p['size'], '?', '?', ''))
+                continue
+            print("  %-10s %#10x %s%#9x %10s %5.1f%%%s" % (
+                    p['name'], p['size'], ' ' if p['exact'] else '~', p['used'],
+                    ('%#x' % p['free']) if p['free'] >= 0 else ('-%#x' % -p['free']),
+                    100.0 * p['used'] / p['size'],
+                    '  << OVERFLOW' if p['name'] in overflow else
+                    '  << OVERFLOW?' if p['name'] in maybeOverflow else ''))
+        print("  %-10s %#10x %#10x %#10x %5.1f%%" % ('side', sideSize, sideUsed,
+                                                     sideSize - sideUsed,
+                                                     100.0 * sideUsed / sideSize if sideSize else 0))
+        if sides > 1:
+            print("  %-10s %#10x %#10x %#10x  (%d sides)" % ('image', sideSize * sides,
+                                                           sideUsed * sides,
+                                                           (sideSize - sideUsed) * sides, sides))
+
+        if self.args.capacity_json:
+            with open(self.args.capacity_json, 'w') as f:
+                json.dump(capacity, f, indent=4)
+
+        if maybeOverflow:
+            print("WARN: section(s) %s may not fit their partition once hashed and signed. "
+                  "Set 'size_overhead' in the config to check them exactly" %
+                  ', '.join(maybeOverflow))
+        if overflow and not self.args.skip_fit_check:
+            raise ImageBuildError("ERROR: section(s) %s do not fit their partition. "
+                                  "Use --skip_fit_check to let flashbuild decide" %
+                                  ', '.join(overflow))
+        return capacity
+
+    def makeHashList(self, archiveName, hashfile):
+        # Create and load the archive
+        archive = self.pak.Archive(archiveName)
+        archive.load()
+
+        # Create all the hashes for the selected files
+        self.out.print("Creating hashes")
+        self.out.moreIndent()
+        for entry in archive:
+           self.out.print(entry.name)
+           entry.hash()
+        self.out.lessIndent()
+
+        #Add the hash.list content
+        archive.add(hashfile, self.pak.CM.store, archive.createHashList())
+
+        # Write the updated archive
+        return archive.save()
+
+    def saveAndRemove(self, archiveName, savedArch, extractList):
+        archive = self.pak.Archive(archiveName)
+        archive.load()
+
+        # An non-existant or empty list would extract everything - don't allow
+        if not extractList:
+            return
 
-notHashed = {}
-
-for sectionName, info in section_info.items():
-    if 'mergedArchive' not in info.keys():
-        continue
-
-    pakname = info['mergedArchive']
-
-    ## Extract and save entries that should not be hashed, then remove them from the archive
-    saveArchive = pak.Archive()
-    if 'noHash' in info.keys():
-        saveAndRemove(pakname, saveArchive, info['noHash'])
+        try:
+            # Filter the list
+            result = archive.find(extractList)
+        except self.pak.ArchiveError as e:
+            self.out.print(str(e))
+            return
 
-    if 'hashlist' in info.keys():
-        #----------------------------
-        # Generate hash.list
-        #----------------------------
-        hashpath = info['hashpath']
-        hashlist = info['hashlist']
+        # Write the files
+        for entry in result:
+            savedArch.append(entry)
+            archive.remove(entry)
 
-        # hashname in archive
-        archivefn = os.path.join(hashpath,hashlist)
+        # Write it back out
+        archive.save()
 
-        # create hash list and add it to the archive
-        makeHashList(pakname, archivefn)
+        return
 
-        # Must be signed, so source pak to sign comes from stage1
-        signImgSrc[sectionName] = pakname
-        # Must be hashed, so source pakname to hash comes from stage2
-        hashImgSrc[sectionName] = pakname.replace(stage1,stage2)
-    elif 'imagehash' in info.keys():
-        # Not to be signed, only hashed, so source pakname to hash is from stage1.
-        hashImgSrc[sectionName] = pakname
+    def restoreSaved(self, archiveName, savedArc):
+        archive = self.pak.Archive(archiveName)
+        archive.load()
 
-    else:
-        asisImgSrc[sectionName] = pakname
-
-    # All paks will exist in stage3 - used to build final flash image
-    finalName = pakname.replace(stage1,stage3)
-    section_info[sectionName]['finalArchive'] = finalName
-    notHashed[sectionName] = saveArchive
-
-#----------------------------
-# Call sbeImageTool signPak
-#----------------------------
-# If running in op-build use the host dir
-if os.environ.get('HOST_DIR'):
-    os.environ['OPBUILD_HOST_DIR'] = os.environ.get('HOST_DIR')
-    os.environ['OPEN_SSL_PATH']='/bin/openssl'
-else:
-    checkEnvVarExist('SIGNING_RHEL_PATH')
-    if not os.environ.get('OPEN_SSL_PATH'):
-         os.environ['OPEN_SSL_PATH']='/bin/openssl'
-
-pakFilesToSign = ""
-for sectionName, pakFile in signImgSrc.items():
-    pakFilesToSign += sectionName + "=" + pakFile + " "
-
-cmd = f"{sbeImageTool} --pakToolDir {pakToolsDir} \
-        signPak --pakFiles {pakFilesToSign}"
-
-print(f"INFO: signing: {pakFilesToSign}")
-
-if os.path.exists(sbeImageTool):
-    resp = subprocess.run(cmd.split())
-    if resp.returncode != 0:
-        print("%s failed with rc %d" % (cmd,resp.returncode))
-        sys.exit(resp.returncode)
-    else:
-        stub_cp(signImgSrc, signedDir)
+        for entry in savedArc:
+            archive.append(entry)
 
-#--------------------------------
-# Call sbeImageTool pakHash
-#--------------------------------
-pakFilesToHash = ""
-for sectionName, pakFile in hashImgSrc.items():
-    pakFilesToHash += sectionName + "=" + pakFile + " "
+        archive.save()
 
-cmd = f"{sbeImageTool} --pakToolDir {pakToolsDir} \
-        pakHash --pakFiles {pakFilesToHash}"
+    def hashSections(self):
+        """Add hash.list to sections that require it and sort the sections
+        into the ones to sign, to hash and to use as is"""
+        for sectionName, info in self.section_info.items():
+            if 'mergedArchive' not in info.keys():
+                continue
 
-print(f"INFO: hashing: {pakFilesToHash}")
+            pakname = info['mergedArchive']
 
-if os.path.exists(sbeImageTool):
-    resp = subprocess.run(cmd.split())
-    if resp.returncode != 0:
-        print("%s failed with rc %d" % (cmd,resp.returncode))
-        sys.exit(resp.returncode)
-    else:
-        stub_cp(hashImgSrc, finalDir)
-
-stub_cp(asisImgSrc, finalDir)
-
-# Use configured 'signed_image' as 'finalArchive' to pack since signing were
-# skipped for those image sections
-for sectionName, info  in section_info.items():
-    if 'signed_image' in info.keys() and not args.allowToSign:
-        print(f"INFO: Copy the configured signed image for '{sectionName}' as final image...")
-        signedImgPath = info['signed_image']
-        for key,value in replacement_tags.items():
-            signedImgPath = signedImgPath.replace(key,value)
-
-        finalArchivePath  = os.path.join(finalDir, f"{sectionName}.pak")
-        shutil.copy(signedImgPath, finalArchivePath)
-        section_info[sectionName]['finalArchive'] = finalArchivePath
-
-# Create image
-cmd = "%s build-image %s %s" % (flashBuildTool, partitionsfile, singleImagefile)
-
-#----------------------------
-# Restore images not hashed
-#----------------------------
-for sectionName, info  in section_info.items():
-    if sectionName in notHashed.keys():
-        archive = notHashed[sectionName]
-        restoreSaved(info['finalArchive'], archive)
-
-    cmd = "%s -p %s=%s" % (cmd, sectionName, info['finalArchive'])
-#print(cmd)
-#-------------------------
-# Create final image
-#-------------------------
-resp = subprocess.run(cmd.split())
-if resp.returncode != 0:
-    print("flashbuild failed with rc %d" % resp.returncode)
-    sys.exit(resp.returncode)
-
-if concatCopies > 1:
-    shutil.copyfile(singleImagefile, imagefile)
-
-    if args.buildGoldenImg:
-        print(f"INFO: Using the custom golden image for the given "
-              f"side count [{args.buildGoldenImg}]")
-        concatCopies = args.buildGoldenImg
-
-    f1 = open(imagefile, 'ab+')
-    for i in range(concatCopies-1):
-        f = open(singleImagefile, 'rb')
-        f1.write(f.read())
-        f.close()
-
-    if 'golden_image' in config.keys() and not args.buildGoldenImg:
-        print("INFO: Using configured golden image to pack in the NOR image")
-        goldenImgPath = config['golden_image']
-
-        goldenImgPath = resolveFile(goldenImgPath, replacement_tags, overrides, binaries)
-
-        goldenImgFd = open(goldenImgPath, 'rb')
-        f1.write(goldenImgFd.read())
-        goldenImgFd.close()
-
-    f1.close()
-
-    if not args.disable_arch_nor_img and "lab_image_config" not in args.configfile:
-        print("INFO: Odyssey pnor image config")
-        # Copy odyssey_nor_DD1.img into odyssey_sbe_debug_DD1.tar.gz
-        archSbeDebugTar = os.path.join(sbeImageDir, "odyssey/odyssey_sbe_debug_DD1.tar.gz")
-        if not os.path.exists(archSbeDebugTar):
-            print(f"{archSbeDebugTar} does not exist", file=sys.stderr)
-            sys.exit(1)
-        else:
-            print("INFO: Untar odyssey_sbe_debug_DD1.tar.gz")
-            archive = tarfile.open(archSbeDebugTar)
-            pathSbeDebugTar = os.path.dirname(os.path.abspath(archSbeDebugTar))
+            ## Extract and save entries that should not be hashed, then remove them from the archive
+            saveArchive = self.pak.Archive()
+            if 'noHash' in info.keys():
+                self.saveAndRemove(pakname, saveArchive, info['noHash'])
+
+            if 'hashlist' in info.keys():
+                #----------------------------
+                # Generate hash.list
+                #----------------------------
+                hashpath = info['hashpath']
+                hashlist = info['hashlist']
+
+                # hashname in archive
+                archivefn = os.path.join(hashpath,hashlist)
+
+                # create hash list and add it to the archive
+                with self.stage('hashlist'):
+                    self.makeHashList(pakname, archivefn)
+                self.perf.addFileBytes('hashlist', pakname)
 
-            if 'filter' in inspect.signature(tarfile.TarFile.extractall).parameters:
-                archive.extractall(pathSbeDebugTar,filter="data")
+                # Must be signed, so source pak to sign comes from stage1
+                self.signImgSrc[sectionName] = pakname
+                # Must be hashed, so source pakname to hash comes from stage2
+                self.hashImgSrc[sectionName] = pakname.replace(self.stage1,self.stage2)
+            elif 'imagehash' in info.keys():
+                # Not to be signed, only hashed, so source pakname to hash is from stage1.
+                self.hashImgSrc[sectionName] = pakname
+
+            else:
+                self.asisImgSrc[sectionName] = pakname
+
+            # All paks will exist in stage3 - used to build final flash image
+            finalName = pakname.replace(self.stage1,self.stage3)
+            info['finalArchive'] = finalName
+            self.notHashed[sectionName] = saveArchive
+
+    def signingEnv(self):
+        """Environment signPak/pakHash sign with. It is part of the section
+        cache key, so sections signed with other keys are never reused."""
+        if os.environ.get('HOST_DIR'):
+            return {'OPBUILD_HOST_DIR' : os.environ.get('HOST_DIR'),
+                    'OPEN_SSL_PATH'    : '/bin/openssl'}
+        return {'SIGNING_RHEL_PATH' : os.environ.get('SIGNING_RHEL_PATH', ''),
+                'OPEN_SSL_PATH'     : os.environ.get('OPEN_SSL_PATH') or '/bin/openssl'}
+
+    def signSections(self):
+        #----------------------------
+        # Call sbeImageTool signPak
+        #----------------------------
+        # If running in op-build use the host dir
+        if not os.environ.get('HOST_DIR'):
+            checkEnvVarExist('SIGNING_RHEL_PATH')
+        os.environ.update(self.signingEnv())
+
+        pakFilesToSign = ""
+        for sectionName, pakFile in self.signImgSrc.items():
+            pakFilesToSign += sectionName + "=" + pakFile + " "
+
+        cmd = f"{self.sbeImageTool} --pakToolDir {self.pakToolsDir} \
+                signPak --pakFiles {pakFilesToSign}"
+
+        print(f"INFO: signing: {pakFilesToSign}")
+
+        if self.signImgSrc and os.path.exists(self.sbeImageTool):
+            with self.stage('sign'):
+                self.run(cmd)
+            self.perf.addFileBytes('sign', *self.signImgSrc.values())
+            # pakHash updates the signed paks
+            stageFiles(self.signImgSrc, self.signedDir, diverge=self.signImgSrc.keys())
+
+    def hashPaks(self):
+        #--------------------------------
+        # Call sbeImageTool pakHash
+        #--------------------------------
+        pakFilesToHash = ""
+        for sectionName, pakFile in self.hashImgSrc.items():
+            pakFilesToHash += sectionName + "=" + pakFile + " "
+
+        cmd = f"{self.sbeImageTool} --pakToolDir {self.pakToolsDir} \
+                pakHash --pakFiles {pakFilesToHash}"
+
+        print(f"INFO: hashing: {pakFilesToHash}")
+
+        # Sections with entries to restore are modified in the final stage
+        restored = [name for name, info in self.section_info.items() if 'noHash' in info.keys()]
+
+        if self.hashImgSrc and os.path.exists(self.sbeImageTool):
+            with self.stage('hash'):
+                self.run(cmd)
+            self.perf.addFileBytes('hash', *self.hashImgSrc.values())
+            stageFiles(self.hashImgSrc, self.finalDir, diverge=restored)
+
+        stageFiles(self.asisImgSrc, self.finalDir, diverge=restored)
+
+    def buildImage(self):
+        # Use configured 'signed_image' as 'finalArchive' to pack since signing were
+        # skipped for those image sections
+        for sectionName, info  in self.section_info.items():
+            if 'signed_image' in info.keys() and not self.args.allowToSign:
+                print(f"INFO: Copy the configured signed image for '{sectionName}' as final image...")
+                signedImgPath = self.replaceTags(info['signed_image'])
+                self.inputFiles.add(signedImgPath)
+
+                finalArchivePath  = os.path.join(self.finalDir, f"{sectionName}.pak")
+                linkFile(signedImgPath, finalArchivePath)
+                info['finalArchive'] = finalArchivePath
+
+        # Create image
+        cmd = "%s build-image %s %s" % (self.flashBuildTool, self.partitionsfile, self.singleImagefile)
+
+        #----------------------------
+        # Restore images not hashed
+        #----------------------------
+        for sectionName, info  in self.section_info.items():
+            if sectionName in self.notHashed.keys():
+                archive = self.notHashed[sectionName]
+                self.restoreSaved(info['finalArchive'], archive)
+
+            cmd = "%s -p %s=%s" % (cmd, sectionName, info['finalArchive'])
+        #print(cmd)
+        #-------------------------
+        # Create final image
+        #-------------------------
+        with self.stage('flashbuild'):
+            self.run(cmd, "flashbuild failed with rc %d")
+            if self.args.sparse:
+                self.sparsifyImage(self.singleImagefile)
+        self.perf.addFileBytes('flashbuild', self.singleImagefile)
+
+        for sectionName, info in self.section_info.items():
+            if 'sectionDigest' in info.keys():
+                self.builtSections[sectionName] = info['sectionDigest']
             else:
-                archive.extractall(pathSbeDebugTar)
+                self.builtSections.pop(sectionName, None)
+
+        # Share the sections built here
+        if self.sectionCache:
+            for sectionName, info in self.section_info.items():
+                if 'mergedArchive' in info.keys() and 'sectionDigest' in info.keys():
+                    self.sectionCache.store(info['sectionDigest'], info['finalArchive'])
+            print(f"INFO: {self.sectionCache.summary()}")
+
+    def sparsifyImage(self, path):
+        holes = sparsify(path)
+        print(f"INFO: {os.path.basename(path)}: {holes:#x} of {os.path.getsize(path):#x} "
+              "bytes are holes")
+
+    def concatImage(self):
+        args = self.args
+        if self.concatCopies <= 1:
+            return
+
+        concatCopies = self.concatCopies
+        with self.stage('concat'):
+            copyFile(self.singleImagefile, self.imagefile, sparse=args.sparse)
+
+            if args.buildGoldenImg:
+                print(f"INFO: Using the custom golden image for the given "
+                      f"side count [{args.buildGoldenImg}]")
+                concatCopies = args.buildGoldenImg
+
+            with open(self.imagefile, 'r+b', buffering=0) as f1:
+                for i in range(concatCopies-1):
+                    appendFile(self.singleImagefile, f1, sparse=args.sparse)
+
+                if 'golden_image' in self.config.keys() and not args.buildGoldenImg:
+                    print("INFO: Using configured golden image to pack in the NOR image")
+                    goldenImgPath = self.resolveFile(self.config['golden_image'])
+
+                    appendFile(goldenImgPath, f1, sparse=args.sparse)
+        self.perf.addFileBytes('concat', self.imagefile)
+
+    def updateDebugTar(self):
+        if self.concatCopies <= 1:
+            return
+        if self.args.disable_arch_nor_img or "lab_image_config" in self.args.configfile:
+            return
 
-            archive.close()
+        print("INFO: Odyssey pnor image config")
+        # Copy odyssey_nor_DD1.img into odyssey_sbe_debug_DD1.tar.gz
+        archSbeDebugTar = os.path.join(self.sbeImageDir, "odyssey/odyssey_sbe_debug_DD1.tar.gz")
+        if not os.path.exists(archSbeDebugTar):
+            raise ImageBuildError(f"{archSbeDebugTar} does not exist")
 
-            # Remove odyssey_sbe_debug_DD1.tar.gz
-            os.remove(archSbeDebugTar)
+        with self.stage('debug-tar'):
+            print("INFO: Untar odyssey_sbe_debug_DD1.tar.gz")
+            # Rebuilt in the workspace and published to output, the sbe
+            # tree is not modified
+            pathSbeDebugTar = os.path.join(self.workDir, 'debug')
+            if os.path.exists(pathSbeDebugTar):
+                shutil.rmtree(pathSbeDebugTar)
+            extractTar(archSbeDebugTar, pathSbeDebugTar)
 
             print("INFO: Copy odyssey_nor_DD1.img into extracted odyssey_debug_files_tools")
             pathSbeDebugTools = os.path.join(pathSbeDebugTar, "odyssey_debug_files_tools")
-            shutil.copy(imagefile, pathSbeDebugTools)
+            linkFile(self.imagefile, pathSbeDebugTools)
 
             # open imagefile to check for info.txt
-            imgArchive = pak.Archive(imagefile)
+            imgArchive = self.pak.Archive(self.imagefile)
             imgArchive.load()
 
             try:
                 # get the info.txt for runtime
                 data = imgArchive.extract('info.txt')
                 pathInfoTxt = os.path.join(pathSbeDebugTools, "info.txt")
-                outfile = open(pathInfoTxt, 'wb')
-                outfile.write(bytearray(data))
-                outfile.close()
-            except pak.ArchiveError as e:
-               out.print(str(e))
+                with open(pathInfoTxt, 'wb') as outfile:
+                    outfile.write(bytearray(data))
+            except self.pak.ArchiveError as e:
+               self.out.print(str(e))
 
             print("INFO: Archive odyssey_debug_files_tools into tar file odyssey_sbe_debug_DD1.tar.gz")
-            archive = tarfile.open(archSbeDebugTar, "w:gz")
-            archive.add(pathSbeDebugTools, arcname=os.path.basename(pathSbeDebugTools))
-            archive.close()
-
-            # Remove directory odyssey_debug_files_tools
-            shutil.rmtree(pathSbeDebugTools)
-
-#--------------------------
-# ecc
-#--------------------------
-eccImagefile = imagefile+'.ecc'
-cmd = "%s --inject %s --output %s --p8" % (sbeEccTool,imagefile,eccImagefile)
-resp = subprocess.run(cmd.split())
-if resp.returncode != 0:
-    print("ecc failed with rc %d" % resp.returncode)
-    sys.exit(resp.returncode)
-
-#--------------------------
-# Run SBE test cases
-#--------------------------
-if args.sbe_test:
-    print("------------------------")
-    print("Running SBE test cases")
-    print("------------------------")
-    if not os.path.exists(sbeBase):
-        print(f"{sbeBase} is not exist", file=sys.stderr)
-        sys.exit(1)
-    elif not os.path.exists(os.path.join(sbeBase, "internal")):
-        print(f"Not found 'internal' directory in {sbeBase} to run test cases")
-        sys.exit(1)
-
-    os.chdir(sbeBase)
-
-    workon_cmd = config['sbeWorkon']
-    runtest_cmd = f"./sbe runtest {output}"
-    with subprocess.Popen(workon_cmd.split(),stdin=subprocess.PIPE) as proc:
-        proc.communicate(input=str.encode(runtest_cmd))
+            self.debugTarfile = os.path.join(self.workDir, os.path.basename(archSbeDebugTar))
+            if os.path.exists(self.debugTarfile):
+                # Left in a --workspace by an earlier run, may be published
+                os.remove(self.debugTarfile)
+            createTar(self.debugTarfile, pathSbeDebugTools, self.epoch)
+
+            # Remove the extracted odyssey_debug_files_tools
+            shutil.rmtree(pathSbeDebugTar)
+        self.perf.addFileBytes('debug-tar', self.debugTarfile)
+
+    def eccImage(self):
+        #--------------------------
+        # ecc
+        #--------------------------
+        cmd = "%s --inject %s --output %s --p8" % (self.sbeEccTool,self.imagefile,self.eccImagefile)
+        with self.stage('ecc'):
+            self.run(cmd, "ecc failed with rc %d")
+            if self.args.sparse:
+                self.sparsifyImage(self.eccImagefile)
+        self.perf.addFileBytes('ecc', self.eccImagefile)
+
+    def publish(self):
+        """Put the finished images and debug archive into the output directory.
+        Every file is replaced atomically, and all of them under the publish
+        lock of the output directory, so builds sharing an output directory
+        never leave a partial file or files of different builds there."""
+        staged = []
+        published = []
+        try:
+            for path in [self.imagefile, self.singleImagefile, self.eccImagefile, self.debugTarfile]:
+                if not path or not os.path.exists(path):
+                    continue
+                dst = os.path.join(self.output, os.path.basename(path))
+                if dst in [d for t, d in staged]:
+                    continue
+                tmpPath = tempPath(dst)
+                staged.append((tmpPath, dst))
+                linkFile(path, tmpPath)
+
+            with open(os.path.join(self.output, '.publish.lock'), 'a') as lock:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                while staged:
+                    tmpPath, dst = staged[0]
+                    os.replace(tmpPath, dst)
+                    staged.pop(0)
+                    published.append(dst)
+        finally:
+            for tmpPath, dst in staged:
+                if os.path.lexists(tmpPath):
+                    os.remove(tmpPath)
+        print(f"INFO: Published {' '.join(os.path.basename(p) for p in published)} to {self.output}")
+        return published
+
+    def sbeCommit(self):
+        """Commit of the sbe repository the tests come from, with a digest of
+        any uncommitted changes. None when sbeBase is not a git repository."""
+        resp = self.subprocessRun(['git', '-C', self.sbeBase, 'rev-parse', 'HEAD'],
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if resp.returncode != 0:
+            return None
+        commit = resp.stdout.decode().strip()
+        resp = self.subprocessRun(['git', '-C', self.sbeBase, 'diff', 'HEAD'],
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if resp.returncode != 0:
+            return None
+        if resp.stdout:
+            commit += '-dirty-' + hashlib.sha256(resp.stdout).hexdigest()
+        return commit
+
+    def exportImage(self, path):
+        """Write the images into a chunked compressed container (see
+        imageExport.py) with the sides and partitions as regions"""
+        singleSize = os.path.getsize(self.singleImagefile)
+        partitions = [(name, info['partition_size']) for name, info in self.section_info.items()]
+        if sum(size for name, size in partitions) != singleSize:
+            print(f"WARN: partitions do not add up to {self.singleImagefile}, "
+                  "exporting without partition regions")
+            partitions = [('image', singleSize)]
+
+        sides = 1
+        if self.concatCopies > 1:
+            sides = self.args.buildGoldenImg or self.concatCopies
+        goldenSize = os.path.getsize(self.imagefile) - sides * singleSize
+
+        files = [(os.path.basename(self.imagefile), self.imagefile),
+                 (os.path.basename(self.eccImagefile), self.eccImagefile)]
+        regions = {files[0][0] : imageExport.imageRegions(partitions, sides, goldenSize),
+                   files[1][0] : imageExport.imageRegions(partitions, sides, goldenSize, ecc=True)}
+        if self.singleImagefile != self.imagefile:
+            files.append((os.path.basename(self.singleImagefile), self.singleImagefile))
+            regions[files[-1][0]] = imageExport.imageRegions(partitions, 1)
+
+        with self.stage('export'):
+            index = imageExport.writeContainer(path, files, regions,
+                                               chunkSize=self.args.export_chunk_size,
+                                               codec=self.args.export_codec,
+                                               jobs=self.jobs.jobs, slot=self.jobs.slot)
+        self.perf.addFileBytes('export', *[f for name, f in files])
+        total = sum(entry['size'] for entry in index['files'])
+        print(f"INFO: exported {len(files)} file(s) to {path}: {os.path.getsize(path)} of "
+              f"{total} bytes, {len(index['chunks'])} unique chunk(s)")
+        return path
+
+    def runSbeTest(self, prefix=''):
+        #--------------------------
+        # Run SBE test cases
+        #--------------------------
+        print("------------------------")
+        print("Running SBE test cases")
+        print("------------------------")
+        sbeBase = self.sbeBase
+        if not os.path.exists(sbeBase):
+            raise ImageBuildError(f"{sbeBase} is not exist")
+        elif not os.path.exists(os.path.join(sbeBase, "internal")):
+            raise ImageBuildError(f"Not found 'internal' directory in {sbeBase} to run test cases")
+
+        # The workspace has the images and sbe_tools, like an output directory
+        workon_cmd = self.config['sbeWorkon']
+        runtest_cmd = f"./sbe runtest {self.workDir}"
+
+        key = None
+        if self.testCache:
+            commit = self.sbeCommit()
+            if commit is None:
+                print(f"INFO: {sbeBase} is not a git repository, test results are not cached")
+            else:
+                images = {os.path.basename(f): fileDigest(f)
+                          for f in (self.imagefile, self.eccImagefile, self.singleImagefile)
+                          if os.path.exists(f)}
+                # The output directory differs between builds, only the command matters
+                key = testResults.resultKey(images, commit, f"{workon_cmd} | ./sbe runtest")
+                result = self.testCache.lookup(key)
+                if result and not self.args.sbe_test_rerun:
+                    print(f"INFO: SBE test cases already {'passed' if result['result'] == 'pass' else 'failed'} "
+                          f"for these images and sbe {commit[:12]}, not running them again "
+                          f"(log: {result['log']})")
+                    if result['result'] != 'pass':
+                        raise ImageBuildError(f"SBE test cases is failed, returncode: "
+                                              f"{result['returncode']} (cached, use --sbe_test_rerun "
+                                              "to run them again)")
+                    return
+
+        logFile = os.path.join(self.genDir, 'sbe_test.log')
+        start = time.time()
+        with self.stage('sbe-test'), open(logFile, 'wb') as log:
+            with self.popen(workon_cmd.split(), cwd=sbeBase, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as proc:
+                proc.stdin.write(str.encode(runtest_cmd))
+                proc.stdin.close()
+                for line in proc.stdout:
+                    log.write(line)
+                    sys.stdout.write(prefix + line.decode(errors='replace'))
+                    sys.stdout.flush()
+                self.communicate(proc)
+
+        result = {'result'     : 'pass' if proc.returncode == 0 else 'fail',
+                  'returncode' : proc.returncode,
+                  'seconds'    : time.time() - start}
+        if key:
+            result.update(sbe_commit=commit, images=images)
+            logFile = self.testCache.store(key, result, logFile)
+        print(f"INFO: SBE test log: {logFile}")
         if proc.returncode != 0:
-            print(f"SBE test cases is failed, returncode: {proc.returncode}",
-                  file=sys.stderr)
-            os.chdir(cwd)
-            sys.exit(1)
+            raise ImageBuildError(f"SBE test cases is failed, returncode: {proc.returncode}")
+
+    def build(self, incremental=False):
+        """Run all stages. Returns the path of the generated image.
+        An incremental build only rebuilds the sections whose inputs changed
+        since the last build of this builder. The images are published to
+        the output directory before the (early) sbe test result is awaited."""
+        testRun = None
+        published = False
+        self.failed = True
+        try:
+            self.prepare(incremental)
+            self.buildPartitionTable()
+            self.mergeSections(incremental)
+            self.checkCapacity()
+            self.hashSections()
+            self.signSections()
+            self.hashPaks()
+            self.buildImage()
+            self.concatImage()
+            self.eccImage()
+
+            # The tests only need the images, so they can run while the
+            # debug archive is packaged
+            if self.args.sbe_test and self.args.sbe_test_early:
+                testPool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                testRun = testPool.submit(self.runSbeTest, 'sbe-test: ')
+                testPool.shutdown(wait=False)
+
+            self.updateDebugTar()
+
+            if self.args.export:
+                self.exportImage(self.args.export)
+
+            self.publish()
+            published = True
+
+            if testRun:
+                testRun.result()
+            elif self.args.sbe_test:
+                self.runSbeTest()
+        finally:
+            if testRun:
+                concurrent.futures.wait([testRun])
+            # Saved once the sbe-test stage is over, also when the tests fail
+            if published and self.args.perf_history:
+                self.perf.save(self.args.perf_history)
+
+        self.prepared = True
+        self.failed = False
+        return self.outputImagefile
+
+    def _snapshot(self, paths):
+        # (mtime, size) of the watched files, plus the listing of watched dirs
+        state = {}
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                state[path] = None
+                continue
+            if os.path.isdir(path):
+                state[path] = sorted(os.listdir(path))
+            else:
+                state[path] = (st.st_mtime_ns, st.st_size)
+        return state
+
+    def watchedInputs(self):
+        """Inputs of the last build. Files this tool writes itself (the gen
+        and output directories) are not watched."""
+        paths = set()
+        generated = (self.output + os.sep, self.workDir + os.sep, self.extractCache.dir + os.sep)
+        for path in self.inputFiles:
+            if not os.path.abspath(path).startswith(generated):
+                paths.add(path)
+        if self.sbeToolsTar:
+            # Re-extracted and the tools discovered again when it changes
+            paths.add(self.sbeToolsTar)
+        if self.args.ovrd:
+            ovrd = os.path.realpath(os.path.expanduser(self.args.ovrd))
+            paths.add(ovrd)
+            paths.update(self.overrides.values())
+        return sorted(paths)
+
+    def reloadConfig(self):
+        """Read the config file again, including the settings the paths and
+        tools are derived from (concat, ekbImageSubDir, sbeTools). A different
+        sbeTools archive is picked up by resolveTools() on the next build."""
+        config = readConfigFile(self.configFile)
+        old = self.config
+        self.config = config
+        try:
+            self._setupPaths()
+        except ImageBuildError:
+            self.config = old
+            self._setupPaths()
+            raise
+
+    def watch(self, interval=1.0, debounce=2.0):
+        """Build, then rebuild incrementally whenever an input changes, until
+        interrupted"""
+        def rebuild():
+            start = time.time()
+            try:
+                self.build(incremental=True)
+            except Exception as e:
+                # Anything from a half written input (pakcore errors, files
+                # vanishing) only fails this build, the watch goes on
+                if isinstance(e, ImageBuildError):
+                    print(str(e), file=sys.stderr)
+                else:
+                    print(f"ERROR: {type(e).__name__}: {e}", file=sys.stderr)
+                print(f"INFO: build failed after {time.time() - start:.2f}s, waiting for changes")
+            else:
+                print(f"INFO: built {self.outputImagefile} in {time.time() - start:.2f}s, "
+                      f"rebuilt sections: {', '.join(self.rebuiltSections) or 'none'}")
+            return self._snapshot(self.watchedInputs())
+
+        state = rebuild()
+        print(f"INFO: watching {len(state)} inputs, Ctrl-C to stop")
+        try:
+            while True:
+                time.sleep(interval)
+                current = self._snapshot(state.keys())
+                if current == state:
+                    continue
+
+                # Wait until the inputs stop changing, e.g. while ./sbe build
+                # is still writing its images
+                while True:
+                    time.sleep(debounce)
+                    settled = self._snapshot(state.keys())
+                    if settled == current:
+                        break
+                    current = settled
+
+                changed = [p for p in state.keys() if state[p] != current.get(p)]
+                print(f"INFO: changed: {' '.join(changed)}")
+                if self.configFile in changed:
+                    try:
+                        self.reloadConfig()
+                    except ImageBuildError as e:
+                        print(str(e), file=sys.stderr)
+                        state = current
+                        continue
+                state = rebuild()
+        except KeyboardInterrupt:
+            print("INFO: stopped watching")
+
+
+def makeParser():
+    parser = argparse.ArgumentParser(description="Build image",
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog=textwrap.dedent('''
+
+    examples:
+      > imageBuild.py configs/odyssey/dd1/ody_pnor_dd1_image_config -o ./image_output -n pnor.bin
+      > imageBuild.py perf-report --help
+      > imageBuild.py container --help
+    '''))
+
+    parser.add_argument('configfile',
+                        help="The configuration file used to build the image.")
+    parser.add_argument('-b','--build',action='store_true',
+                        help='Downloads ekb and sbe repositories (if not found), '
+                        'then checks out branchs and builds them. Note: Requires '
+                        ' --ekb and --sbe, or --build_workdir')
+    parser.add_argument('--nobranchchange', action='store_true',
+                        help="Don't change the branch when building")
+    parser.add_argument('--update', action='store_true',
+                        help='After changing to specified branch, '
+                        'update it from the server as well')
+    parser.add_argument('--devready', action='store_true',
+                        help='Apply dev-ready ekb and sbe commits on top of branch')
+    parser.add_argument('--devreadyekb', action='store_true',
+                        help='Apply dev-ready ekb commits on top of branch')
+    parser.add_argument('--devreadysbe', action='store_true',
+                        help='Apply dev-ready sbe commits on top of branch')
+    parser.add_argument('--ekb',default=None,
+                        help='Base path of the ekb git repository.'
+                        ' Use --ekb_images instead for pre-built images')
+    parser.add_argument('--ekb_images',default=None,
+                        help='Image directory of pre-built ekb images.')
+    parser.add_argument('--sbe',default=None,
+                        help='Base path of sbe repository or sbe images. Default: use value '
+                        'in configfile')
+    parser.add_argument('--ovrd',default=None,
+                        help='Directory to look for override source files.'
+                        ' Files must have same name as those being overridden')
+    parser.add_argument('-o','--output', default='./image_output',
+                        help='output directory. default ./image_output')
+    parser.add_argument('-n','--name', default='image.bin',
+                        help='output image filename. default: image.bin')
+    parser.add_argument('--pakToolDir',default=None,
+                        help='Directory of PAK tools. '
+                        'PAK tool override. Only required if PAK tools not available in '
+                        'ekb,sbe,or sbe_tools.')
+    parser.add_argument('--sbe_test',action='store_true',
+                        help='Run sbe test cases to validate the images')
+    parser.add_argument('--sbe_test_early', action='store_true',
+                        help='Start the sbe test cases as soon as the ecc image exists, '
+                        'while the rest of the build is still packaged')
+    parser.add_argument('--sbe_test_cache', default=testResults.DEFAULT_DIR, metavar='DIR',
+                        help='Directory of recorded sbe test results. Tests are skipped when '
+                        'the images and the sbe commit were tested before. default: %(default)s')
+    parser.add_argument('--no_sbe_test_cache', dest='sbe_test_cache', action='store_const',
+                        const=None, help="Don't record or reuse sbe test results")
+    parser.add_argument('--sbe_test_rerun', action='store_true',
+                        help='Run the sbe test cases even if a result is recorded for the images')
+    parser.add_argument('--build_workdir', type=str,
+                        help='Work directory for the build. '
+                        'Tool will ignore xxxxRoot configure parameter value.')
+    parser.add_argument('--buildGoldenImg', type=int, metavar="SIDE_COUNT",
+                        help='Use to build golden image with the side count '
+                             'instead of the configured frozen golden image.'
+                             'The golden image will be used for the given sides.')
+    parser.add_argument('--allowToSign', action='store_true',
+                        help='Use to allow the signing process for the frozen '
+                             'configured image_sections.')
+    parser.add_argument('--no_downloads', action='store_true',
+                        help='Disable downloading any repositories/binaries etc.')
+    parser.add_argument('--disable_arch_nor_img', action='store_true',
+                        help='disable nor image copy into debug archive')
+    parser.add_argument('--cache_url', default=os.environ.get('IMAGEBUILD_CACHE_URL'),
+                        help='URL of a shared section cache (see cacheServer.py). '
+                        'Sections whose inputs are unchanged are fetched instead of '
+                        'being merged, hashed and signed again. '
+                        'default: $IMAGEBUILD_CACHE_URL')
+    parser.add_argument('--no_cache_upload', action='store_true',
+                        help='Only fetch from the section cache, never upload to it')
+    parser.add_argument('--perf_history', default=perfHistory.DEFAULT_HISTORY,
+                        help='File to append the per-stage performance of this build to. '
+                        'See "imageBuild.py perf-report". default: %(default)s')
+    parser.add_argument('--no_perf_history', dest='perf_history', action='store_const', const=None,
+                        help="Don't record the performance of this build")
+    parser.add_argument('--capacity_json', '--capacity-json', default=None, metavar='FILE',
+                        help='Save the partition capacity table (size/used/free per '
+                        'partition and side) as json')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of jobs (tools, merges) to run at the same time. '
+                        'default: use the make jobserver from MAKEFLAGS if there is one, '
+                        'else the number of CPUs')
+    parser.add_argument('--max_memory', '--max-memory', type=parseSize, default=None,
+                        metavar='SIZE',
+                        help='Address space limit (e.g. 2G) of each tool started, applied with prlimit. '
+                        'A per tool cap, not a budget for the whole build')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and rebuild the image whenever an input (archives, '
+                        '--ovrd files, config file, section files) changes. Only changed '
+                        'sections are merged, hashed and signed again')
+    parser.add_argument('--watch_interval', type=float, default=1.0, metavar='SECONDS',
+                        help='How often --watch checks the inputs. default 1')
+    parser.add_argument('--watch_debounce', type=float, default=2.0, metavar='SECONDS',
+                        help='How long the inputs must be unchanged before --watch '
+                        'rebuilds. default 2')
+    parser.add_argument('--workspace', default=None, metavar='DIR',
+                        help='Scratch directory of this build (gen directory, binaries, images '
+                        'before they are published to --output). It is locked while the build '
+                        'runs and kept. default: a new directory under <output>/workspaces, '
+                        'removed after a successful build')
+    parser.add_argument('--keep_workspace', action='store_true',
+                        help="Don't remove the temporary workspace after the build")
+    parser.add_argument('--shared_cache', default=sharedCache.DEFAULT_DIR, metavar='DIR',
+                        help='Read-only cache of extracted archives (sbe_tools, .tar.gz inputs) '
+                        'shared by the builds of the host. default: %(default)s')
+    parser.add_argument('--reproducible', action='store_true',
+                        help='Make the outputs depend only on the inputs: the debug archive '
+                        'gets normalized tar metadata and gzip header, with timestamps '
+                        'clamped to $SOURCE_DATE_EPOCH (default 0), which is also passed to '
+                        'the tools')
+    parser.add_argument('--sparse', action='store_true',
+                        help='Write zero filled blocks (partition padding) of the images as '
+                        'file holes and keep them through concat. The content does not change')
+    parser.add_argument('--export', default=None, metavar='FILE',
+                        help='Also write the images into a chunked, compressed and '
+                        'deduplicated container. See "imageBuild.py container --help"')
+    parser.add_argument('--export_codec', choices=sorted(imageExport.CODECS), default='zlib',
+                        help='Compression of the --export container. default: zlib')
+    parser.add_argument('--export_chunk_size', type=parseSize,
+                        default=imageExport.DEFAULT_CHUNK_SIZE, metavar='SIZE',
+                        help='Chunk size of the --export container, the unit of '
+                        'deduplication and random access. default: 64K')
+    parser.add_argument('--skip_fit_check', action='store_true',
+                        help="Don't stop the build when a section is estimated to overflow "
+                        'its partition')
+    return parser
+
 
-    os.chdir(cwd)
+############################################################
+# Main - Main - Main - Main - Main - Main - Main - Main
+############################################################
+
+def main(argv):
+    # 'perf-report' is a separate command with its own arguments
+    if len(argv) > 0 and argv[0] == 'perf-report':
+        return perfHistory.main(argv[1:])
+    if len(argv) > 0 and argv[0] == 'container':
+        return imageExport.main(argv[1:])
+    if len(argv) > 0 and argv[0] == 'prune':
+        return sharedCache.main(argv[1:])
+
+    args = makeParser().parse_args(argv)
+    try:
+        with ImageBuilder(args.configfile, args) as builder:
+            if args.watch:
+                builder.watch(args.watch_interval, args.watch_debounce)
+            else:
+                builder.build()
+    except ImageBuildError as e:
+        print(str(e), file=sys.stderr)
+        return e.rc
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
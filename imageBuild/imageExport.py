@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# Chunked, compressed container for the image outputs
+#
+# The files are cut into fixed size chunks. Every distinct chunk is
+# compressed once (zlib, bz2 or lzma from the python stdlib, in parallel)
+# and stored once, so zero padding and the repeated sides of a concat image
+# take almost no space. An index at the end maps every file to its chunks
+# and names the regions (sides, golden image, partitions) of the images, so
+# a single region can be read by decompressing only the chunks it covers.
+#
+# Layout:
+#   MAGIC
+#   compressed chunks, back to back
+#   index (json, zlib compressed)
+#   trailer: index offset, index length (little endian u64), MAGIC
+import os
+import sys
+import bz2
+import lzma
+import zlib
+import json
+import stat
+import struct
+import hashlib
+import argparse
+import collections
+import contextlib
+import concurrent.futures
+
+from stageFiles import dataRanges
+
+MAGIC   = b'OPIMGX\x00\x01'
+VERSION = 1
+TRAILER = struct.Struct('<QQ8s')
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+CODECS = {
+    'zlib' : (lambda data: zlib.compress(data, 9), zlib.decompress),
+    'bz2'  : (lambda data: bz2.compress(data, 9), bz2.decompress),
+    'lzma' : (lambda data: lzma.compress(data, preset=6), lzma.decompress),
+}
+
+class ContainerError(Exception):
+    pass
+
+def _readChunks(fd, chunkSize):
+    # Chunks of a file, chunks that are all hole are not read from disk
+    size = os.fstat(fd).st_size
+    ranges = list(dataRanges(fd, size))
+    zero = bytes(chunkSize)
+    i = 0
+    for pos in range(0, size, chunkSize):
+        n = min(chunkSize, size - pos)
+        while i < len(ranges) and ranges[i][1] <= pos:
+            i += 1
+        if i == len(ranges) or ranges[i][0] >= pos + n:
+            yield zero[:n]
+        else:
+            yield os.pread(fd, n, pos)
+
+def writeContainer(path, files, regions=None, chunkSize=DEFAULT_CHUNK_SIZE, codec='zlib',
+                   jobs=None, slot=None):
+    """Write the [(name, filePath)] files into the container 'path'.
+    regions is {name: {regionName: (offset, size)}}. Every chunk compression
+    runs inside slot() when given, to share a job limit with other work.
+    Returns the index."""
+    compress = CODECS[codec][0]
+    jobs = jobs or os.cpu_count() or 1
+    slot = slot or contextlib.nullcontext
+
+    def compressChunk(data):
+        with slot():
+            return compress(data)
+
+    index = {'version': VERSION, 'codec': codec, 'chunk_size': chunkSize,
+             'chunks': [], 'files': [], 'regions': regions or {}}
+    chunkIds = {}
+    tmpPath = path + '.part'
+    with open(tmpPath, 'wb') as out, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        out.write(MAGIC)
+        pending = collections.deque()
+
+        def writeOldest():
+            chunkId, size, digest, future = pending.popleft()
+            blob = future.result()
+            index['chunks'].append([out.tell(), len(blob), size, digest])
+            assert len(index['chunks']) == chunkId + 1
+            out.write(blob)
+
+        for name, filePath in files:
+            h = hashlib.sha256()
+            entry = {'name': name, 'size': 0, 'chunks': [],
+                     'mode': stat.S_IMODE(os.stat(filePath).st_mode)}
+            with open(filePath, 'rb') as f:
+                for data in _readChunks(f.fileno(), chunkSize):
+                    h.update(data)
+                    entry['size'] += len(data)
+                    digest = hashlib.sha256(data).hexdigest()
+                    if digest not in chunkIds:
+                        chunkIds[digest] = len(chunkIds)
+                        pending.append((chunkIds[digest], len(data), digest,
+                                        pool.submit(compressChunk, data)))
+                        # Chunks are written in order, bound the ones held in memory
+                        while len(pending) > jobs * 4:
+                            writeOldest()
+                    entry['chunks'].append(chunkIds[digest])
+            entry['sha256'] = h.hexdigest()
+            index['files'].append(entry)
+
+        while pending:
+            writeOldest()
+
+        blob = zlib.compress(json.dumps(index, sort_keys=True).encode(), 9)
+        indexOffset = out.tell()
+        out.write(blob)
+        out.write(TRAILER.pack(indexOffset, len(blob), MAGIC))
+    os.replace(tmpPath, path)
+    return index
+
+class Container:
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        try:
+            if self.f.read(len(MAGIC)) != MAGIC:
+                raise ContainerError(f"{path} is not an image container")
+            self.f.seek(-TRAILER.size, os.SEEK_END)
+            indexOffset, indexLength, magic = TRAILER.unpack(self.f.read(TRAILER.size))
+            if magic != MAGIC:
+                raise ContainerError(f"{path} is truncated")
+            self.f.seek(indexOffset)
+            self.index = json.loads(zlib.decompress(self.f.read(indexLength)))
+        except (OSError, ValueError, zlib.error, struct.error) as e:
+            self.f.close()
+            raise ContainerError(f"{path} is not a valid image container: {e}")
+        if self.index.get('version') != VERSION:
+            self.f.close()
+            raise ContainerError(f"{path}: unsupported container version {self.index.get('version')}")
+        self.decompress = CODECS[self.index['codec']][1]
+        self.files = {entry['name']: entry for entry in self.index['files']}
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def chunk(self, chunkId):
+        offset, length, size, digest = self.index['chunks'][chunkId]
+        self.f.seek(offset)
+        data = self.decompress(self.f.read(length))
+        if len(data) != size or hashlib.sha256(data).hexdigest() != digest:
+            raise ContainerError(f"{self.path}: chunk {chunkId} is corrupted")
+        return data
+
+    def _entry(self, name):
+        if name not in self.files:
+            raise ContainerError(f"{name} is not in {self.path}, it has: {', '.join(self.files)}")
+        return self.files[name]
+
+    def regions(self, name):
+        return self.index['regions'].get(name, {})
+
+    def iterRange(self, name, offset=0, size=None):
+        """Yield the bytes of name[offset:offset+size], decompressing only the
+        chunks in that range"""
+        entry = self._entry(name)
+        chunkSize = self.index['chunk_size']
+        end = entry['size'] if size is None else min(entry['size'], offset + size)
+        pos = offset
+        while pos < end:
+            i = pos // chunkSize
+            data = self.chunk(entry['chunks'][i])
+            start = pos - i * chunkSize
+            data = data[start:min(len(data), end - i * chunkSize)]
+            yield data
+            pos += len(data)
+
+    def read(self, name, offset=0, size=None):
+        return b''.join(self.iterRange(name, offset, size))
+
+    def readRegion(self, name, region):
+        regions = self.regions(name)
+        if region not in regions:
+            raise ContainerError(f"{name} has no region '{region}', it has: {', '.join(regions)}")
+        offset, size = regions[region]
+        return self.read(name, offset, size)
+
+    def extract(self, name, dstPath):
+        """Write name to dstPath, checking it is byte identical to the file
+        that was exported"""
+        entry = self._entry(name)
+        h = hashlib.sha256()
+        tmpPath = dstPath + '.part'
+        with open(tmpPath, 'wb') as out:
+            for data in self.iterRange(name):
+                h.update(data)
+                out.write(data)
+        if h.hexdigest() != entry['sha256']:
+            os.remove(tmpPath)
+            raise ContainerError(f"{self.path}: {name} does not match its digest")
+        os.chmod(tmpPath, entry['mode'])
+        os.replace(tmpPath, dstPath)
+        return dstPath
+
+def imageRegions(partitions, sideCount, goldenSize=0, ecc=False):
+    """Regions of a concat image made of sideCount copies of a side with the
+    [(name, size)] partitions, followed by a golden image of goldenSize.
+    With ecc the offsets are those in the .ecc file (8 data bytes + 1 ecc byte)."""
+    scale = (lambda n: n * 9 // 8) if ecc else (lambda n: n)
+    sideSize = sum(size for name, size in partitions)
+    regions = {}
+    for side in range(sideCount):
+        base = side * sideSize
+        regions[f'side{side}'] = (scale(base), scale(sideSize))
+        offset = base
+        for name, size in partitions:
+            regions[f'side{side}/{name}'] = (scale(offset), scale(size))
+            offset += size
+    if goldenSize:
+        regions['golden'] = (scale(sideCount * sideSize), scale(goldenSize))
+    return regions
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='imageBuild.py container',
+                                     description='List or unpack an image container '
+                                     'written by imageBuild.py --export')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('list', help='Show the files, regions and compression of a container')
+    p.add_argument('container')
+    p = sub.add_parser('unpack', help='Extract files, or a single region of a file')
+    p.add_argument('container')
+    p.add_argument('names', nargs='*',
+                   help='Files to extract, or FILE:REGION (e.g. image.bin:side1/rt). '
+                   'default: all files')
+    p.add_argument('-o', '--output', default='.',
+                   help='Output directory. default: current directory')
+    args = parser.parse_args(argv)
+
+    try:
+        with Container(args.container) as container:
+            if args.command == 'list':
+                index = container.index
+                stored = sum(c[1] for c in index['chunks'])
+                total = sum(e['size'] for e in index['files'])
+                print(f"{args.container}: {len(index['files'])} file(s), codec {index['codec']}, "
+                      f"{len(index['chunks'])} unique chunk(s) of {index['chunk_size']:#x}")
+                for entry in index['files']:
+                    print("  %-20s %#12x %s" % (entry['name'], entry['size'], entry['sha256']))
+                    for region, (offset, size) in sorted(container.regions(entry['name']).items(),
+                                                         key=lambda r: (r[1][0], -r[1][1])):
+                        print("      %-20s %#12x %#12x" % (region, offset, size))
+                print(f"  {total} bytes stored in {stored} "
+                      f"({100.0 * stored / total if total else 0:.1f}%)")
+                return 0
+
+            os.makedirs(args.output, exist_ok=True)
+            for name in args.names or list(container.files):
+                if ':' in name:
+                    name, region = name.split(':', 1)
+                    dstPath = os.path.join(args.output, f"{name}.{region.replace('/', '.')}")
+                    with open(dstPath, 'wb') as out:
+                        out.write(container.readRegion(name, region))
+                else:
+                    dstPath = container.extract(name, os.path.join(args.output, name))
+                print(f"INFO: wrote {dstPath}")
+    except ContainerError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# Limits on the jobs imageBuild.py runs at the same time
+#
+# When imageBuild.py is started from make (op-build), MAKEFLAGS carries the
+# jobserver of the outer 'make -j': a pipe or fifo holding one token per job
+# slot. Every job beyond the one implicit slot this process already owns
+# takes a token from it first and gives it back when done, so the whole
+# tree stays within the outer -j. Without a jobserver a local limit of
+# --jobs slots is used instead. There is one JobServer per process
+# (sharedJobServer()), so several builders in a process share the slots.
+#
+# --max-memory is a cap on the address space of every single tool, applied
+# with prlimit(1). It is not a budget for the whole build: a tool that goes
+# over it fails, it is not held back until memory is free.
+import os
+import re
+import select
+import shutil
+import threading
+import contextlib
+
+def parseSize(value):
+    """'512M', '2G', '1048576' -> bytes"""
+    m = re.fullmatch(r'\s*(\d+)\s*([KMGT]?)i?B?\s*', str(value), re.IGNORECASE)
+    if not m:
+        raise ValueError(f"invalid size '{value}'")
+    return int(m.group(1)) << (10 * ' KMGT'.index(m.group(2).upper() or ' '))
+
+def limitCommand(args, maxMemory, shell=False):
+    """(args, shell) to start the tool args with, under the maxMemory cap.
+    prlimit runs the tool in place of a preexec_fn, which is not safe while
+    other threads start tools."""
+    if not maxMemory:
+        return (args, shell)
+    if not shutil.which('prlimit'):
+        raise ValueError("a memory limit needs prlimit (util-linux) in PATH")
+    wrapper = ['prlimit', f'--as={maxMemory}', '--']
+    if shell:
+        # The same as subprocess does for shell=True
+        return (wrapper + ['/bin/sh', '-c'] + list(args), False)
+    return (wrapper + list(args), False)
+
+_shared = None
+_sharedLock = threading.Lock()
+
+def sharedJobServer(jobs=None):
+    """The JobServer of this process, created by the first caller with its
+    jobs. Every builder of the process takes its slots from it, so they stay
+    within one -j together."""
+    global _shared
+    with _sharedLock:
+        if _shared is None:
+            _shared = JobServer(jobs)
+        elif jobs is not None and jobs != _shared.jobs:
+            print(f"WARN: --jobs {jobs} ignored, this process already runs "
+                  f"{_shared.describe()}")
+        return _shared
+
+class JobServer:
+    def __init__(self, jobs=None, makeflags=None):
+        if makeflags is None:
+            makeflags = os.environ.get('MAKEFLAGS', '')
+        self.readFd = None
+        self.writeFd = None
+        self.fifo = None
+        self.implicit = threading.Lock()   # the slot this process already has
+        self.local = None
+
+        auth = None
+        for word in makeflags.split():
+            if word.startswith('--jobserver-auth=') or word.startswith('--jobserver-fds='):
+                auth = word.split('=', 1)[1]
+
+        if auth and jobs is None:
+            try:
+                if auth.startswith('fifo:'):
+                    self.fifo = auth[len('fifo:'):]
+                    self.readFd = os.open(self.fifo, os.O_RDONLY | os.O_NONBLOCK)
+                    self.writeFd = os.open(self.fifo, os.O_WRONLY)
+                else:
+                    self.readFd, self.writeFd = (int(fd) for fd in auth.split(','))
+                    os.fstat(self.readFd)
+                    os.fstat(self.writeFd)
+            except (OSError, ValueError):
+                # make only hands the jobserver to recipes it knows run make
+                # ('+' or $(MAKE)), otherwise the fds are closed
+                print(f"WARN: make jobserver '{auth}' not usable, running one job at a time")
+                self.readFd = self.writeFd = None
+                jobs = 1
+
+        if self.readFd is None:
+            if jobs is None:
+                # Under make without a jobserver (-j1) stay serial
+                jobs = 1 if makeflags.strip() else (os.cpu_count() or 1)
+            self.jobs = max(1, jobs)
+            self.local = threading.BoundedSemaphore(self.jobs - 1) if self.jobs > 1 else None
+        else:
+            self.jobs = None
+
+    def describe(self):
+        if self.readFd is not None:
+            return "make jobserver"
+        return f"{self.jobs} job(s)"
+
+    def _readToken(self):
+        while True:
+            # The read end may be non-blocking (always for the fifo)
+            select.select([self.readFd], [], [])
+            try:
+                token = os.read(self.readFd, 1)
+            except BlockingIOError:
+                continue
+            if token:
+                return token
+
+    def acquire(self):
+        """Returns a token to hand back to release()"""
+        if self.implicit.acquire(blocking=False):
+            return None
+        if self.readFd is not None:
+            return self._readToken()
+        if self.local is None:
+            # Only one job allowed: wait for the implicit slot
+            self.implicit.acquire()
+            return None
+        self.local.acquire()
+        return b'+'
+
+    def release(self, token):
+        if token is None:
+            self.implicit.release()
+        elif self.readFd is not None:
+            os.write(self.writeFd, token)
+        else:
+            self.local.release()
+
+    @contextlib.contextmanager
+    def slot(self):
+        token = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    def popenArgs(self):
+        """subprocess arguments that let child makes (ekb/sbe builds) share
+        the jobserver"""
+        kwargs = {}
+        if self.readFd is not None and self.fifo is None:
+            kwargs['pass_fds'] = (self.readFd, self.writeFd)
+        return kwargs
+
+    def close(self):
+        if self.fifo is not None:
+            os.close(self.readFd)
+            os.close(self.writeFd)
+            self.readFd = self.writeFd = None
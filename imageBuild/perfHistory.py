@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# Per-build performance history for imageBuild.py
+#
+# Every build appends one JSON line to the history file with the duration,
+# bytes processed and peak memory of each stage. 'imageBuild.py perf-report'
+# shows the trend per stage and flags stages that got slower than their
+# rolling baseline.
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import threading
+import statistics
+import contextlib
+
+DEFAULT_HISTORY = os.environ.get('IMAGEBUILD_PERF_HISTORY',
+                                 '~/.cache/op-image-tools/perf_history.jsonl')
+
+# Stages in build order, used to order reports
+STAGES = ['resolve', 'merge', 'fit-check', 'hashlist', 'sign', 'hash', 'flashbuild',
+          'concat', 'ecc', 'debug-tar', 'export', 'sbe-test']
+
+def peakMemoryKb():
+    # Peak of the whole build so far. ru_maxrss is in KiB on Linux.
+    # Sub-tools (paktool, imageTool, ecc) run as children, so report
+    # whichever peak is larger.
+    selfPeak  = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    childPeak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(selfPeak, childPeak)
+
+class PerfRecorder:
+    def __init__(self, configName):
+        self.configName   = configName
+        self.inputDigests = {}
+        self.stages       = {}
+        self.start        = time.time()
+        self.local        = threading.local()
+        # Builds that skip work are kept out of the regression baseline
+        self.incremental    = False
+        self.reusedSections = []
+
+    def _entry(self, name):
+        return self.stages.setdefault(name, {'seconds': 0.0, 'bytes': 0, 'peak_kb': 0})
+
+    def current(self):
+        """The innermost stage of the calling thread, or None"""
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time a stage. Entering the same stage again adds to its totals."""
+        entry = self._entry(name)
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        self.local.stack.append(name)
+        t0 = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry['seconds'] += time.perf_counter() - t0
+            self.local.stack.pop()
+
+    def bind(self, fn):
+        """fn, to be called from another thread as part of the current stage"""
+        name = self.current()
+        if name is None:
+            return fn
+        def inStage(*args, **kwargs):
+            if not hasattr(self.local, 'stack'):
+                self.local.stack = []
+            self.local.stack.append(name)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.local.stack.pop()
+        return inStage
+
+    def addToolPeak(self, peakKb):
+        """Record the peak memory (ru_maxrss of its own wait4) of a tool that
+        ran in the current stage. A stage's peak_kb is the largest of its tools."""
+        name = self.current()
+        if name is not None:
+            entry = self._entry(name)
+            entry['peak_kb'] = max(entry['peak_kb'], peakKb)
+
+    def addBytes(self, name, count):
+        self._entry(name)['bytes'] += count
+
+    def addFileBytes(self, name, *paths):
+        for path in paths:
+            if os.path.exists(path):
+                self.addBytes(name, os.path.getsize(path))
+
+    def record(self):
+        return {
+            'timestamp' : self.start,
+            'config'    : self.configName,
+            'inputs'    : self.inputDigests,
+            'total'     : time.time() - self.start,
+            'peak_kb'   : peakMemoryKb(),
+            'stages'    : self.stages,
+            'incremental'     : self.incremental,
+            'reused_sections' : sorted(self.reusedSections),
+        }
+
+    def save(self, historyFile):
+        historyFile = os.path.expanduser(historyFile)
+        os.makedirs(os.path.dirname(os.path.abspath(historyFile)), exist_ok=True)
+        # One line per build, a single append keeps concurrent builds from
+        # interleaving records
+        with open(historyFile, 'a') as f:
+            f.write(json.dumps(self.record(), sort_keys=True) + '\n')
+
+def loadHistory(historyFile, configName=None):
+    records = []
+    historyFile = os.path.expanduser(historyFile)
+    if not os.path.exists(historyFile):
+        return records
+    with open(historyFile, 'r') as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                print(f"WARN: {historyFile}:{lineno} is not a valid record, skipped",
+                      file=sys.stderr)
+                continue
+            if configName and rec.get('config') != configName:
+                continue
+            records.append(rec)
+    records.sort(key=lambda r: r.get('timestamp', 0))
+    return records
+
+def isFullBuild(record):
+    """False for incremental (watch) builds and builds that took sections from
+    the section cache, their merge/sign/hash stages did not do all the work"""
+    return not record.get('incremental') and not record.get('reused_sections')
+
+def findRegressions(records, window, threshold, minSeconds):
+    """Compare the latest build with the median of the 'window' full builds
+    before it. Returns {stage: (baseline, latest)} for stages that slowed down
+    by more than 'threshold' (fraction) and at least minSeconds."""
+    regressions = {}
+    if len(records) < 2:
+        return regressions
+    latest   = records[-1]['stages']
+    previous = [r for r in records[:-1] if isFullBuild(r)][-window:]
+    for name, entry in latest.items():
+        history = [r['stages'][name]['seconds'] for r in previous if name in r['stages']]
+        if not history:
+            continue
+        baseline = statistics.median(history)
+        if (entry['seconds'] - baseline >= minSeconds and
+                entry['seconds'] > baseline * (1 + threshold)):
+            regressions[name] = (baseline, entry['seconds'])
+    return regressions
+
+def stageOrder(name):
+    return (STAGES.index(name) if name in STAGES else len(STAGES), name)
+
+def printReport(records, regressions, trend):
+    last = records[-trend:]
+    names = sorted({n for r in last for n in r['stages']}, key=stageOrder)
+
+    print(f"{len(records)} build(s), showing last {len(last)} (oldest first, seconds)")
+    labels = ['%8s' % ('-%d' % (len(last) - 1 - i)) for i in range(len(last) - 1)] + ['latest']
+    labels = ['%8s' % (label + ('' if isFullBuild(r) else '*')) for label, r in zip(labels, last)]
+    print("%-12s %s %10s %12s" % ('stage', ' '.join(labels), 'MiB', 'tool MiB'))
+    for name in names:
+        times = ['%8.2f' % r['stages'][name]['seconds'] if name in r['stages'] else '%8s' % '-'
+                 for r in last]
+        entry = last[-1]['stages'].get(name, {'bytes': 0, 'peak_kb': 0})
+        flag = '  << SLOWER' if name in regressions else ''
+        peak = '%12.1f' % (entry['peak_kb'] / 1024) if entry['peak_kb'] else '%12s' % '-'
+        print("%-12s %s %10.2f %s%s" % (name, ' '.join(times),
+                                        entry['bytes'] / (1024*1024), peak, flag))
+    print("%-12s %s" % ('total', ' '.join('%8.2f' % r['total'] for r in last)))
+    if not all(isFullBuild(r) for r in last):
+        print("* incremental or with cached sections, not part of the baseline")
+
+    for name, (baseline, latest) in sorted(regressions.items(), key=lambda i: stageOrder(i[0])):
+        print(f"REGRESSION: {name} took {latest:.2f}s, baseline {baseline:.2f}s "
+              f"(+{(latest / baseline - 1) * 100 if baseline else float('inf'):.0f}%)")
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='imageBuild.py perf-report',
+                                     description='Show image build performance history')
+    parser.add_argument('--history', default=DEFAULT_HISTORY,
+                        help='History file. default: %(default)s')
+    parser.add_argument('--config', default=None,
+                        help='Only use builds of this config file name')
+    parser.add_argument('--window', type=int, default=5,
+                        help='Number of previous builds in the rolling baseline. default 5')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Flag stages slower than baseline by more than this '
+                        'fraction. default 0.25')
+    parser.add_argument('--min_seconds', type=float, default=0.5,
+                        help='Ignore slow downs smaller than this. default 0.5')
+    parser.add_argument('--trend', type=int, default=8,
+                        help='Number of builds to show. default 8')
+    args = parser.parse_args(argv)
+
+    records = loadHistory(args.history, args.config)
+    if not records:
+        print(f"No builds recorded in {os.path.expanduser(args.history)}")
+        return 0
+
+    # Builds of different configs are not comparable, default to the config
+    # of the most recent build
+    if not args.config:
+        configs = {r.get('config') for r in records}
+        if len(configs) > 1:
+            print(f"INFO: reporting on {records[-1]['config']}, use --config to select "
+                  f"one of {sorted(configs)}")
+            records = [r for r in records if r.get('config') == records[-1]['config']]
+
+    regressions = findRegressions(records, args.window, args.threshold, args.min_seconds)
+    printReport(records, regressions, args.trend)
+
+    # Non zero so the report can gate a CI job
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
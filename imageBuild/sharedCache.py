@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# Read-only cache of extracted archives shared by the builds of a host
+#
+# sbe_tools.tar.gz and the .tar.gz inputs of the sections are extracted once
+# into <dir>/extract/<sha256 of the archive>, instead of into every output
+# directory or next to the archive in the source tree. The first build that
+# needs an archive extracts it into a temporary directory under a file lock
+# and renames it into place, so other builds either wait for it or see the
+# complete directory. Extracted files are made read-only; builds must copy
+# anything they want to modify into their own workspace.
+#
+# A build holds a shared lock on <key>.lock for as long as it uses the
+# directory. 'imageBuild.py prune' removes the entries nobody holds that
+# were not used for --max_age days, then the least recently used ones until
+# the cache fits --max_size, and the stale workspaces of an output directory.
+import os
+import sys
+import stat
+import time
+import fcntl
+import shutil
+import argparse
+import tempfile
+
+from buildCache import fileDigest
+from jobServer import parseSize
+
+DEFAULT_DIR = os.environ.get('IMAGEBUILD_SHARED_CACHE', '~/.cache/op-image-tools/shared')
+
+def tryLock(path):
+    """Open file holding an exclusive flock on path, or None when someone
+    else holds a lock on it"""
+    f = open(path, 'a')
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+def treeSize(dir):
+    size = 0
+    for root, dirs, files in os.walk(dir):
+        for name in files:
+            size += os.lstat(os.path.join(root, name)).st_size
+    return size
+
+def removeTree(dir):
+    # Rename first, so a partly removed entry is never taken as complete
+    tmpDir = tempfile.mkdtemp(prefix='.removing-', dir=os.path.dirname(dir))
+    os.rename(dir, os.path.join(tmpDir, 'entry'))
+    shutil.rmtree(tmpDir, ignore_errors=True)
+
+def makeReadOnly(dir):
+    for root, dirs, files in os.walk(dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if not os.path.islink(path):
+                mode = stat.S_IMODE(os.lstat(path).st_mode)
+                os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+class SharedCache:
+    def __init__(self, dir):
+        self.dir = os.path.abspath(os.path.expanduser(dir))
+        self.extractDir = os.path.join(self.dir, 'extract')
+        # key: open lock file, shared locked while this process uses the entry
+        self.inUse = {}
+
+    def extract(self, tarPath, extractTar):
+        """Directory holding the content of tarPath, extracted with
+        extractTar(tarPath, dest) by whichever build needs it first. It is
+        not pruned until close()."""
+        key = fileDigest(tarPath)
+        dest = os.path.join(self.extractDir, key)
+        if key in self.inUse:
+            return dest
+
+        os.makedirs(self.extractDir, exist_ok=True)
+        lock = open(os.path.join(self.extractDir, key + '.lock'), 'a')
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_SH)
+            # Converting the lock is not atomic, prune may remove the entry
+            # in between, so check again after every conversion
+            while not os.path.isdir(dest):
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                if not os.path.isdir(dest):
+                    self._extract(tarPath, extractTar, key, dest)
+                fcntl.flock(lock.fileno(), fcntl.LOCK_SH)
+            # Last use, for prune
+            os.utime(dest)
+        except BaseException:
+            lock.close()
+            raise
+        self.inUse[key] = lock
+        return dest
+
+    def _extract(self, tarPath, extractTar, key, dest):
+        tmpDir = tempfile.mkdtemp(prefix='.' + key + '-', dir=self.extractDir)
+        try:
+            extractTar(tarPath, tmpDir)
+            makeReadOnly(tmpDir)
+            os.rename(tmpDir, dest)
+        except BaseException:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+            raise
+        print(f"INFO: Extracted {os.path.basename(tarPath)} into the shared cache {dest}")
+
+    def close(self):
+        """Let prune remove the entries used by this process"""
+        for lock in self.inUse.values():
+            lock.close()
+        self.inUse = {}
+
+    def prune(self, maxAge=None, maxSize=None, dryRun=False):
+        """Remove the entries not used for maxAge seconds, then the least
+        recently used ones until the cache is at most maxSize bytes. Entries
+        that a build is using or extracting are kept. Returns the [(path, size)]
+        removed."""
+        if not os.path.isdir(self.extractDir):
+            return []
+        entries = []
+        for name in os.listdir(self.extractDir):
+            path = os.path.join(self.extractDir, name)
+            if name.startswith('.removing-'):
+                shutil.rmtree(path, ignore_errors=True)
+            elif not name.startswith('.') and os.path.isdir(path):
+                entries.append((os.stat(path).st_mtime, path, treeSize(path)))
+        entries.sort()
+
+        now = time.time()
+        total = sum(size for mtime, path, size in entries)
+        removed = []
+        for mtime, path, size in entries:
+            tooOld = maxAge is not None and now - mtime > maxAge
+            tooBig = maxSize is not None and total > maxSize
+            if not (tooOld or tooBig):
+                continue
+            lock = tryLock(path + '.lock')
+            if lock is None:
+                continue
+            # The lock file stays, a build may be waiting on it
+            with lock:
+                if not dryRun:
+                    removeTree(path)
+            total -= size
+            removed.append((path, size))
+
+        # Left by extractions that were killed, their key is not locked
+        for name in os.listdir(self.extractDir):
+            path = os.path.join(self.extractDir, name)
+            key = name[1:].split('-', 1)[0]
+            if name.startswith('.') and '-' in name and os.path.isdir(path) \
+               and os.path.exists(os.path.join(self.extractDir, key + '.lock')):
+                lock = tryLock(os.path.join(self.extractDir, key + '.lock'))
+                if lock is not None:
+                    with lock:
+                        if not dryRun:
+                            shutil.rmtree(path, ignore_errors=True)
+        return removed
+
+def pruneWorkspaces(root, maxAge, dryRun=False):
+    """Remove the workspaces under root (<output>/workspaces) that no build
+    holds and that were not modified for maxAge seconds. Failed builds keep
+    their workspace, this is what cleans them up. Returns the paths removed."""
+    if not os.path.isdir(root):
+        return []
+    removed = []
+    now = time.time()
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if not os.path.isdir(path) or now - os.stat(path).st_mtime <= maxAge:
+            continue
+        lockPath = os.path.join(path, '.lock')
+        # Not created here, that would make the workspace look recent
+        lock = tryLock(lockPath) if os.path.exists(lockPath) else open(os.devnull)
+        if lock is None:
+            continue
+        with lock:
+            if not dryRun:
+                shutil.rmtree(path, ignore_errors=True)
+        removed.append(path)
+    return removed
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='imageBuild.py prune',
+                                     description='Remove unused entries of the shared '
+                                     'extract cache and stale build workspaces')
+    parser.add_argument('--shared_cache', '--shared-cache', default=DEFAULT_DIR,
+                        help='Shared cache directory. default: %(default)s')
+    parser.add_argument('--output', '-o', action='append', default=[],
+                        help='Also remove the stale workspaces of this output directory. '
+                        'Can be repeated')
+    parser.add_argument('--max_age', '--max-age', type=float, default=14,
+                        help='Remove cache entries not used and workspaces not modified '
+                        'for this many days. default 14')
+    parser.add_argument('--max_size', '--max-size', type=parseSize, default=None,
+                        metavar='SIZE',
+                        help='Then remove the least recently used cache entries until the '
+                        'cache is at most SIZE (e.g. 20G)')
+    parser.add_argument('--dry_run', '--dry-run', action='store_true',
+                        help='Only show what would be removed')
+    args = parser.parse_args(argv)
+
+    maxAge = args.max_age * 24 * 3600
+    verb = 'would remove' if args.dry_run else 'removed'
+    cache = SharedCache(args.shared_cache)
+    removed = cache.prune(maxAge, args.max_size, args.dry_run)
+    for path, size in removed:
+        print(f"INFO: {verb} {path} ({size} bytes)")
+    print(f"INFO: {verb} {len(removed)} cache entries, "
+          f"{sum(size for path, size in removed)} bytes")
+
+    for output in args.output:
+        root = os.path.join(os.path.abspath(os.path.expanduser(output)), 'workspaces')
+        for path in pruneWorkspaces(root, maxAge, args.dry_run):
+            print(f"INFO: {verb} workspace {path}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# Moving files between build stages without spawning cp
+#
+# linkFile  - hardlink, for artifacts that are not modified in the next stage
+# copyFile  - for artifacts whose content will diverge: reflink (shares
+#             blocks until written on btrfs/xfs), then in-kernel
+#             copy_file_range, then a chunked copy in python
+# appendFile - the same copy_file_range/chunked copy, appending to an open file
+# tempPath  - unique name to write a file under before os.replace()
+#
+# With sparse=True copyFile and appendFile only copy the data ranges of the
+# source (SEEK_DATA/SEEK_HOLE), so its holes stay holes in the copy.
+# sparsify() turns the zero filled blocks of a file into holes.
+import os
+import stat
+import errno
+import fcntl
+import tempfile
+
+CHUNK_SIZE = 1024 * 1024
+
+# ioctl to clone a whole file, from linux/fs.h
+FICLONE = 0x40049409
+
+# Read once, while the importing process is still single threaded
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# errors that mean the fast path is not supported here, not that the copy failed
+_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                    errno.ENOTTY, errno.EPERM, errno.EBADF, errno.ETXTBSY}
+
+def _copyData(srcFd, dstFd):
+    # Copy from the current position of srcFd to the current position of dstFd
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while True:
+                n = os.copy_file_range(srcFd, dstFd, CHUNK_SIZE * 64)
+                if n == 0:
+                    return
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+    # copy_file_range moves both offsets, so this picks up where it stopped
+    while True:
+        chunk = os.read(srcFd, CHUNK_SIZE)
+        if not chunk:
+            return
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(dstFd, view):]
+
+def dataRanges(fd, size=None):
+    """Yield the (start, end) ranges of fd that hold data, skipping holes.
+    Where SEEK_DATA is not supported the whole file is one range."""
+    if size is None:
+        size = os.fstat(fd).st_size
+    if not hasattr(os, 'SEEK_DATA'):
+        if size:
+            yield (0, size)
+        return
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return      # only a hole is left
+            if e.errno in _FALLBACK_ERRNOS:
+                yield (pos, size)
+                return
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield (start, end)
+        pos = end
+
+def _copyRange(srcFd, dstFd, start, end, dstOffset):
+    # Copy srcFd[start:end] to dstOffset in dstFd, leaving both offsets alone
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while start < end:
+                n = os.copy_file_range(srcFd, dstFd, end - start, start, dstOffset)
+                if n == 0:
+                    break
+                start += n
+                dstOffset += n
+            if start >= end:
+                return
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+    while start < end:
+        chunk = os.pread(srcFd, min(CHUNK_SIZE, end - start), start)
+        if not chunk:
+            return
+        view = memoryview(chunk)
+        while view:
+            n = os.pwrite(dstFd, view, dstOffset)
+            view = view[n:]
+            dstOffset += n
+        start += len(chunk)
+
+def _copySparse(srcFd, dstFd, dstOffset):
+    # Copy the data ranges of srcFd to dstOffset in dstFd and extend dstFd
+    # over any trailing hole
+    size = os.fstat(srcFd).st_size
+    for start, end in dataRanges(srcFd, size):
+        _copyRange(srcFd, dstFd, start, end, dstOffset + start)
+    if os.fstat(dstFd).st_size < dstOffset + size:
+        os.ftruncate(dstFd, dstOffset + size)
+
+def copyFile(src, dst, sparse=False):
+    """Copy src to dst (a file path or a directory), keeping the mode like cp.
+    With sparse the holes of src are kept."""
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.lexists(dst):
+        os.remove(dst)
+    with open(src, 'rb', buffering=0) as fsrc, open(dst, 'wb', buffering=0) as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+            if sparse:
+                _copySparse(fsrc.fileno(), fdst.fileno(), 0)
+            else:
+                _copyData(fsrc.fileno(), fdst.fileno())
+    os.chmod(dst, stat.S_IMODE(os.stat(src).st_mode))
+    return dst
+
+def linkFile(src, dst):
+    """Hardlink src to dst (a file path or a directory), copying when the two
+    are on different filesystems or links are not allowed"""
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.lexists(dst):
+        if os.path.samefile(src, dst):
+            return dst
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        return copyFile(src, dst)
+    return dst
+
+def tempPath(dst):
+    """New empty file next to dst, unique between builds and threads, to
+    write dst under before os.replace(). Created with the umask mode."""
+    fd, path = tempfile.mkstemp(prefix='.%s.' % os.path.basename(dst), suffix='.tmp',
+                                dir=os.path.dirname(dst) or '.')
+    os.fchmod(fd, 0o666 & ~_UMASK)
+    os.close(fd)
+    return path
+
+def appendFile(src, fdst, sparse=False):
+    """Append the content of src to the open (unbuffered, not O_APPEND) file fdst.
+    With sparse the holes of src are kept."""
+    end = fdst.seek(0, os.SEEK_END)
+    with open(src, 'rb', buffering=0) as fsrc:
+        if sparse:
+            _copySparse(fsrc.fileno(), fdst.fileno(), end)
+        else:
+            _copyData(fsrc.fileno(), fdst.fileno())
+
+def sparsify(path, blockSize=4096):
+    """Rewrite path with its zero filled blocks as holes. The content does
+    not change. Returns the number of bytes in holes."""
+    zero = bytes(blockSize)
+    tmpPath = path + '.sparse'
+    with open(path, 'rb', buffering=0) as fsrc, open(tmpPath, 'wb', buffering=0) as fdst:
+        srcFd, dstFd = fsrc.fileno(), fdst.fileno()
+        size = os.fstat(srcFd).st_size
+        for start, end in dataRanges(srcFd, size):
+            pos = start
+            while pos < end:
+                chunk = os.pread(srcFd, min(CHUNK_SIZE, end - pos), pos)
+                view = memoryview(chunk)
+                for off in range(0, len(chunk), blockSize):
+                    block = view[off:off + blockSize]
+                    if block != zero[:len(block)]:
+                        os.pwrite(dstFd, block, pos + off)
+                pos += len(chunk)
+        os.ftruncate(dstFd, size)
+    os.chmod(tmpPath, stat.S_IMODE(os.stat(path).st_mode))
+    os.replace(tmpPath, path)
+    return holeBytes(path)
+
+def holeBytes(path):
+    """Bytes of path that are not allocated on disk"""
+    st = os.stat(path)
+    return max(0, st.st_size - st.st_blocks * 512)
+
+def stageFiles(src, dir, diverge=()):
+    """Move the files of the {name: path} dict src into dir for the next stage.
+    Files of the names in diverge will be modified there and are copied,
+    the others are linked."""
+    os.makedirs(dir,exist_ok=True)
+    for name, f in src.items():
+        if name in diverge:
+            copyFile(f, dir)
+        else:
+            linkFile(f, dir)
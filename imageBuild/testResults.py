@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Results of sbe test runs, keyed by what was tested
+#
+# The key covers the digests of the produced images, the sbe commit the
+# tests come from and the test command. A build whose images are byte
+# identical to ones already tested with the same sbe commit reuses the
+# recorded result instead of running the tests again.
+#
+# Layout of the cache directory:
+#   <key>.json - result: pass/fail, return code, duration, sbe commit, images
+#   <key>.log  - output of the test run
+import os
+import json
+import time
+import hashlib
+
+from stageFiles import copyFile, tempPath
+
+DEFAULT_DIR = os.environ.get('IMAGEBUILD_TEST_CACHE', '~/.cache/op-image-tools/sbe_tests')
+
+def resultKey(imageDigests, sbeCommit, command):
+    h = hashlib.sha256()
+    def add(tag, value):
+        value = value.encode()
+        h.update(b'%s:%d:' % (tag.encode(), len(value)))
+        h.update(value)
+
+    for name, digest in sorted(imageDigests.items()):
+        add('image', name)
+        add('digest', digest)
+    add('sbe', sbeCommit)
+    add('command', command)
+    return h.hexdigest()
+
+class TestResultCache:
+    def __init__(self, dir):
+        self.dir = os.path.expanduser(dir)
+
+    def _path(self, key, ext):
+        return os.path.join(self.dir, key + ext)
+
+    def lookup(self, key):
+        """Returns the recorded result of 'key', or None"""
+        try:
+            with open(self._path(key, '.json'), 'r') as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if result.get('result') not in ('pass', 'fail'):
+            return None
+        result['log'] = self._path(key, '.log')
+        return result
+
+    def store(self, key, result, logFile):
+        """Record 'result' with a copy of logFile. Every file is written under
+        a temporary name first so that concurrent builds never see a partial
+        record."""
+        os.makedirs(self.dir, exist_ok=True)
+        logPath = self._path(key, '.log')
+        if os.path.exists(logFile):
+            tmpPath = tempPath(logPath)
+            copyFile(logFile, tmpPath)
+            os.replace(tmpPath, logPath)
+
+        record = dict(result, key=key, timestamp=time.time())
+        record.pop('log', None)
+        jsonPath = self._path(key, '.json')
+        tmpPath = tempPath(jsonPath)
+        with open(tmpPath, 'w') as f:
+            json.dump(record, f, indent=1, sort_keys=True)
+        os.replace(tmpPath, jsonPath)
+        return logPath
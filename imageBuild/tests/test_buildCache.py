@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+import threading
+import contextlib
+import http.client
+import http.server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from buildCache import RemoteCache, DIGEST_HEADER, PROTOCOL_VERSION, sectionDigest
+from cacheServer import makeServer
+
+KEY = 'ab' * 32
+OTHER_KEY = 'cd' * 32
+
+@contextlib.contextmanager
+def serving(server):
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%d' % server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+class FixedHandler(http.server.BaseHTTPRequestHandler):
+    """Answers every GET with the class' code, body and digest header"""
+    code = 200
+    body = b'artifact'
+    digest = None
+
+    def do_GET(self):
+        self.send_response(self.code)
+        self.send_header('Content-Length', str(len(self.body)))
+        if self.digest:
+            self.send_header(DIGEST_HEADER, self.digest)
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+def fixedServer(code=200, body=b'artifact', digest=None):
+    handler = type('Handler', (FixedHandler,), {'code': code, 'body': body, 'digest': digest})
+    return http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+
+class RemoteCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        self.storeDir = os.path.join(self.dir, 'store')
+        self.src = os.path.join(self.dir, 'rt.pak')
+        with open(self.src, 'wb') as f:
+            f.write(os.urandom(3 * 1024 * 1024 + 17))
+        self.dst = os.path.join(self.dir, 'fetched.pak')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def assertNothingFetched(self):
+        self.assertFalse(os.path.exists(self.dst))
+        self.assertFalse(os.path.exists(self.dst + '.part'))
+
+    def testUploadRoundTrip(self):
+        with serving(makeServer(self.storeDir, port=0, quiet=True)) as url:
+            cache = RemoteCache(url)
+            self.assertFalse(cache.fetch(KEY, self.dst))
+            self.assertTrue(cache.store(KEY, self.src))
+            self.assertTrue(cache.fetch(KEY, self.dst))
+        self.assertEqual(self.read(self.dst), self.read(self.src))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(os.listdir(self.storeDir), [KEY])
+
+    def testMissIsNotAnError(self):
+        with serving(makeServer(self.storeDir, port=0, quiet=True)) as url:
+            cache = RemoteCache(url)
+            self.assertTrue(cache.store(KEY, self.src))
+            self.assertFalse(cache.fetch(OTHER_KEY, self.dst))
+        self.assertNothingFetched()
+        self.assertEqual(cache.misses, 1)
+
+    def testNoUpload(self):
+        with serving(makeServer(self.storeDir, port=0, quiet=True)) as url:
+            self.assertFalse(RemoteCache(url, upload=False).store(KEY, self.src))
+        self.assertEqual(os.listdir(self.storeDir), [])
+
+    def testServerRejectsCorruptUpload(self):
+        with serving(makeServer(self.storeDir, port=0, quiet=True)) as url:
+            conn = http.client.HTTPConnection(url[len('http://'):])
+            conn.request('PUT', f'/{PROTOCOL_VERSION}/artifacts/{KEY}', body=b'data',
+                         headers={DIGEST_HEADER: hashlib.sha256(b'other').hexdigest()})
+            self.assertEqual(conn.getresponse().status, 422)
+            conn.close()
+        self.assertEqual(os.listdir(self.storeDir), [])
+
+    def testServerRejectsBadRequests(self):
+        with serving(makeServer(self.storeDir, port=0, quiet=True)) as url:
+            for path, length in [(f'/{PROTOCOL_VERSION}/artifacts/{KEY}', 'many'),
+                                 (f'/{PROTOCOL_VERSION}/artifacts/{KEY}', '-1'),
+                                 (f'/{PROTOCOL_VERSION}/artifacts/../etc', '4')]:
+                with self.subTest(path=path, length=length):
+                    conn = http.client.HTTPConnection(url[len('http://'):])
+                    conn.putrequest('PUT', path)
+                    conn.putheader('Content-Length', length)
+                    conn.putheader(DIGEST_HEADER, hashlib.sha256(b'data').hexdigest())
+                    conn.endheaders()
+                    self.assertEqual(conn.getresponse().status, 400)
+                    conn.close()
+        self.assertEqual(os.listdir(self.storeDir), [])
+
+    def testClientRejectsCorruptArtifact(self):
+        for digest in [hashlib.sha256(b'other').hexdigest(), None]:
+            with self.subTest(digest=digest):
+                with serving(fixedServer(digest=digest)) as url:
+                    cache = RemoteCache(url)
+                    self.assertFalse(cache.fetch(KEY, self.dst))
+                self.assertNothingFetched()
+                self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def testClientAcceptsVerifiedArtifact(self):
+        with serving(fixedServer(digest=hashlib.sha256(b'artifact').hexdigest())) as url:
+            self.assertTrue(RemoteCache(url).fetch(KEY, self.dst))
+        self.assertEqual(self.read(self.dst), b'artifact')
+
+    def testServerErrorFallsBack(self):
+        with serving(fixedServer(code=503, body=b'busy\n')) as url:
+            cache = RemoteCache(url)
+            self.assertFalse(cache.fetch(KEY, self.dst))
+            self.assertFalse(cache.store(KEY, self.src))
+        self.assertNothingFetched()
+        self.assertEqual(cache.misses, 1)
+
+    def testUnreachableServerFallsBack(self):
+        server = makeServer(self.storeDir, port=0, quiet=True)
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+        server.server_close()
+        cache = RemoteCache(url, timeout=5)
+        self.assertFalse(cache.fetch(KEY, self.dst))
+        self.assertFalse(cache.store(KEY, self.src))
+        self.assertNothingFetched()
+
+class SectionDigestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def testKeyDependsOnContentNotLocation(self):
+        info = {'partition_size': 0x1000, 'mergedArchive': 'a', 'finalArchive': 'b'}
+        arc = self.write('a/rt.pak', b'rt')
+        tool = self.write('a/paktool', b'tool v1')
+        key = sectionDigest('rt', info, [arc], [], [tool], ['rhel'])
+
+        moved = shutil.copy(arc, self.write('b/rt.pak', b''))
+        self.assertEqual(sectionDigest('rt', dict(info, mergedArchive='c'), [moved], [],
+                                       [tool], ['rhel']), key)
+        self.assertNotEqual(sectionDigest('rt', info, [arc], [], [tool], ['opbuild']), key)
+        self.write('a/paktool', b'tool v2')
+        self.assertNotEqual(sectionDigest('rt', info, [arc], [], [tool], ['rhel']), key)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import os
+import sys
+import random
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import imageExport
+from imageExport import writeContainer, Container, ContainerError, imageRegions
+
+# Two sides of two partitions, followed by a golden image
+PARTITIONS = [('boot', 0x3000), ('rt', 0x5000)]
+SIDES = 2
+GOLDEN = 0x1000
+
+class ImageExportTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        rnd = random.Random(1)
+        side = b''.join(rnd.randbytes(0x800) + bytes(size - 0x800) for name, size in PARTITIONS)
+        self.image = side * SIDES + rnd.randbytes(GOLDEN)
+        # Not a real ecc, only its size matters to the regions
+        self.ecc = rnd.randbytes(len(self.image) * 9 // 8)
+        # Size not a multiple of the chunk size
+        self.single = rnd.randbytes(0x2345)
+        self.files = []
+        for name, data, mode in [('image.bin', self.image, 0o644),
+                                 ('image.bin.ecc', self.ecc, 0o644),
+                                 ('single_image.bin', self.single, 0o600)]:
+            path = os.path.join(self.dir, name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            os.chmod(path, mode)
+            self.files.append((name, path))
+        self.regions = {
+            'image.bin': imageRegions(PARTITIONS, SIDES, GOLDEN),
+            'image.bin.ecc': imageRegions(PARTITIONS, SIDES, GOLDEN, ecc=True),
+        }
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def export(self, codec='zlib'):
+        path = os.path.join(self.dir, 'image.opx')
+        writeContainer(path, self.files, self.regions, chunkSize=0x1000, codec=codec, jobs=2)
+        return path
+
+    def testUnpackIsByteIdentical(self):
+        for codec in imageExport.CODECS:
+            with self.subTest(codec=codec):
+                outDir = os.path.join(self.dir, 'out-' + codec)
+                os.makedirs(outDir)
+                with Container(self.export(codec)) as container:
+                    for name, path in self.files:
+                        dstPath = container.extract(name, os.path.join(outDir, name))
+                        with open(path, 'rb') as src, open(dstPath, 'rb') as dst:
+                            self.assertEqual(src.read(), dst.read())
+                        self.assertEqual(os.stat(dstPath).st_mode, os.stat(path).st_mode)
+
+    def testRepeatedChunksAreStoredOnce(self):
+        with Container(self.export()) as container:
+            chunks = container.index['chunks']
+            used = sum(len(entry['chunks']) for entry in container.index['files'])
+            self.assertLess(len(chunks), used)
+
+    def testReadRegionMatchesSource(self):
+        with Container(self.export()) as container:
+            for name, data in [('image.bin', self.image), ('image.bin.ecc', self.ecc)]:
+                for region, (offset, size) in self.regions[name].items():
+                    with self.subTest(name=name, region=region):
+                        self.assertEqual(container.readRegion(name, region),
+                                         data[offset:offset + size])
+
+    def testEccRegionsAreScaled(self):
+        plain = self.regions['image.bin']
+        ecc = self.regions['image.bin.ecc']
+        self.assertEqual(set(plain), set(ecc))
+        for region, (offset, size) in plain.items():
+            self.assertEqual(ecc[region], (offset * 9 // 8, size * 9 // 8))
+        sideSize = sum(size for name, size in PARTITIONS)
+        self.assertEqual(ecc['side1/rt'], ((sideSize + 0x3000) * 9 // 8, 0x5000 * 9 // 8))
+        self.assertEqual(ecc['golden'][0] + ecc['golden'][1], len(self.ecc))
+
+    def testUnknownRegion(self):
+        with Container(self.export()) as container:
+            with self.assertRaises(ContainerError):
+                container.readRegion('image.bin', 'side2')
+            with self.assertRaises(ContainerError):
+                container.readRegion('single_image.bin', 'side0')
+
+    def testUnpackRegionCommand(self):
+        path = self.export()
+        outDir = os.path.join(self.dir, 'out')
+        self.assertEqual(imageExport.main(['unpack', '-o', outDir, path,
+                                           'image.bin.ecc:side1/boot']), 0)
+        offset, size = self.regions['image.bin.ecc']['side1/boot']
+        with open(os.path.join(outDir, 'image.bin.ecc.side1.boot'), 'rb') as f:
+            self.assertEqual(f.read(), self.ecc[offset:offset + size])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import os
+import sys
+import random
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stageFiles import copyFile, appendFile, sparsify, dataRanges, holeBytes
+
+BLOCK = 0x10000
+
+def writeSparse(path, size, extents):
+    """File of size bytes holding the data of the {offset: bytes} extents,
+    holes elsewhere"""
+    with open(path, 'wb') as f:
+        for offset, data in extents.items():
+            f.seek(offset)
+            f.write(data)
+        f.truncate(size)
+    with open(path, 'rb') as f:
+        return f.read()
+
+def ranges(path):
+    with open(path, 'rb') as f:
+        return list(dataRanges(f.fileno()))
+
+def supportsHoles(dir):
+    path = os.path.join(dir, 'probe')
+    writeSparse(path, 4 * BLOCK, {0: b'x'})
+    return hasattr(os, 'SEEK_DATA') and holeBytes(path) > 0 and len(ranges(path)) == 1
+
+class SparseTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        if not supportsHoles(self.dir):
+            self.skipTest('the filesystem of %s has no holes' % self.dir)
+        rnd = random.Random(1)
+        # Leading data, hole, data, trailing hole
+        self.srcPath = os.path.join(self.dir, 'src')
+        self.src = writeSparse(self.srcPath, 8 * BLOCK,
+                               {0: rnd.randbytes(BLOCK), 4 * BLOCK: rnd.randbytes(BLOCK)})
+        # Leading hole, data
+        self.src2Path = os.path.join(self.dir, 'src2')
+        self.src2 = writeSparse(self.src2Path, 4 * BLOCK, {3 * BLOCK: rnd.randbytes(BLOCK)})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def testSparseCopyKeepsContentAndHoles(self):
+        dst = copyFile(self.srcPath, os.path.join(self.dir, 'dst'), sparse=True)
+        self.assertEqual(self.read(dst), self.src)
+        self.assertEqual(ranges(dst), ranges(self.srcPath))
+        self.assertGreaterEqual(holeBytes(dst), 6 * BLOCK)
+
+    def testCopyKeepsContent(self):
+        dst = copyFile(self.srcPath, os.path.join(self.dir, 'dst'))
+        self.assertEqual(self.read(dst), self.src)
+
+    def testSparseAppendKeepsContentAndHoles(self):
+        dst = os.path.join(self.dir, 'dst')
+        with open(dst, 'wb', buffering=0) as f:
+            f.write(b'head')
+            appendFile(self.srcPath, f, sparse=True)
+            appendFile(self.src2Path, f, sparse=True)
+            # Ends in a hole, the size must still cover it
+            appendFile(self.srcPath, f, sparse=True)
+        expected = b'head' + self.src + self.src2 + self.src
+        self.assertEqual(os.path.getsize(dst), len(expected))
+        self.assertEqual(self.read(dst), expected)
+        # Every hole of the sources stays a hole, only the block shared with
+        # 'head' may have been filled
+        self.assertGreaterEqual(holeBytes(dst), (6 + 3 + 6) * BLOCK - BLOCK)
+        for start, end in ranges(dst):
+            self.assertNotEqual(expected[start:end].strip(b'\0'), b'',
+                                'range %#x-%#x holds only zeros' % (start, end))
+
+    def testAppendKeepsContent(self):
+        dst = os.path.join(self.dir, 'dst')
+        with open(dst, 'wb', buffering=0) as f:
+            appendFile(self.srcPath, f)
+            appendFile(self.src2Path, f)
+        self.assertEqual(self.read(dst), self.src + self.src2)
+
+    def testSparsifyKeepsContent(self):
+        rnd = random.Random(2)
+        path = os.path.join(self.dir, 'image')
+        data = rnd.randbytes(BLOCK) + bytes(3 * BLOCK) + b'\xff' * BLOCK + bytes(BLOCK)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.assertEqual(holeBytes(path), 0)
+        holes = sparsify(path)
+        self.assertEqual(self.read(path), data)
+        self.assertEqual(holes, 4 * BLOCK)
+        self.assertGreaterEqual(holeBytes(path), 4 * BLOCK)
+        # 0xff fill is data, not a hole
+        self.assertIn((4 * BLOCK, 5 * BLOCK), ranges(path))
+
+if __name__ == '__main__':
+    unittest.main()